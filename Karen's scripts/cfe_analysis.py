@@ -0,0 +1,207 @@
+"""Plate-reader analysis of the buffer optimization runs.
+
+Joins the kinetic plate-reader export of every plate to the DOE.csv the
+protocol wrote for it, by well, and fits response surfaces of the yield and
+rate over the factors. The export is a CSV with the read time in the first
+column (s, or h:mm:ss) and one column per well (A1 ... P24), one row per
+read. It is streamed in chunks of rows, so only the running metrics of the
+384 wells are held in memory however long the read.
+
+    python cfe_analysis.py --plate run1/DOE.csv run1/reader.csv --plate run2/DOE.csv run2/reader.csv --output conditions.csv --surface surface.csv
+
+Metrics of every well:
+    Initial, Final, Max     first, last and highest signal
+    Yield                   final minus initial signal
+    Max rate (/h)           steepest rise of the signal over --window reads
+    Time of max rate (h)    from the well's DNA start, taking the read to
+                            start with the last DNA addition
+"""
+
+import argparse
+import itertools
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+
+# Columns of DOE.csv that are not factors
+doe_columns = ['Well', 'DNA start (s)']
+metrics = ['Initial', 'Final', 'Max', 'Yield', 'Max rate (/h)', 'Time of max rate (h)']
+well_pattern = re.compile(r'^[A-P]([1-9]|1[0-9]|2[0-4])$')
+
+
+def to_seconds(times):
+    """Read times in s from a column of seconds or h:mm:ss."""
+    numbers = pd.to_numeric(times, errors='coerce')
+    if numbers.notna().all():
+        return numbers.to_numpy(float)
+    return pd.to_timedelta(times.astype(str)).dt.total_seconds().to_numpy(float)
+
+
+def read_kinetics(path, chunksize=1000):
+    """Stream a kinetic export, yields the read times in s, the wells and
+    the (reads, wells) signal of every chunk of rows. Cells that are not
+    numbers, e.g. OVRFLW, are NaN."""
+    for chunk in pd.read_csv(path, chunksize=chunksize):
+        chunk.columns = [str(column).strip() for column in chunk.columns]
+        wells = [column for column in chunk.columns[1:] if well_pattern.match(column)]
+        values = chunk[wells].apply(pd.to_numeric, errors='coerce').to_numpy(float)
+        yield to_seconds(chunk[chunk.columns[0]]), wells, values
+
+
+class WellMetrics:
+    """Running metrics of every well over the chunks of a kinetic read.
+    The last window reads of a chunk are kept to take the rate across the
+    border to the next chunk."""
+
+    def __init__(self, wells, window=3):
+        self.wells = wells
+        self.window = window
+        self.initial = None
+        self.final = None
+        self.max = np.full(len(wells), -np.inf)
+        self.rate = np.full(len(wells), -np.inf)
+        self.rate_time = np.full(len(wells), np.nan)
+        self.tail_times = np.empty(0)
+        self.tail = np.empty((0, len(wells)))
+
+    def add(self, times, values):
+        if self.initial is None:
+            self.initial = values[0].copy()
+        self.final = values[-1].copy()
+        self.max = np.fmax(self.max, np.nanmax(values, axis=0))
+
+        times = np.concatenate([self.tail_times, times])
+        values = np.concatenate([self.tail, values])
+        if len(times) > self.window:
+            w = self.window
+            slopes = (values[w:] - values[:-w]) / (times[w:] - times[:-w])[:, None] * 3600
+            slopes = np.where(np.isnan(slopes), -np.inf, slopes)
+            best = slopes.argmax(axis=0)
+            rate = slopes[best, np.arange(len(self.wells))]
+            better = rate > self.rate
+            self.rate = np.where(better, rate, self.rate)
+            self.rate_time = np.where(better, (times[best] + times[best + w]) / 2 / 3600, self.rate_time)
+        self.tail_times = times[-self.window:]
+        self.tail = values[-self.window:]
+
+    def table(self):
+        """Metrics of every well, indexed by well."""
+        return pd.DataFrame({
+            'Initial': self.initial,
+            'Final': self.final,
+            'Max': self.max,
+            'Yield': self.final - self.initial,
+            'Max rate (/h)': np.where(np.isfinite(self.rate), self.rate, np.nan),
+            'Time of max rate (h)': self.rate_time,
+        }, index=pd.Index(self.wells, name='Well'))
+
+
+def analyse_plate(doe_path, reader_paths, window=3, chunksize=1000):
+    """Metrics of the wells of one plate joined to its design. A plate read
+    in several exports is given as several paths, in read order."""
+    doe = pd.read_csv(doe_path, index_col=0)
+    running = None
+    for path in reader_paths:
+        for times, wells, values in read_kinetics(path, chunksize):
+            if running is None:
+                running = WellMetrics(wells, window)
+            elif wells != running.wells:
+                raise ValueError("Error: {} does not have the wells of the first export of the plate.".format(path))
+            running.add(times, values)
+    if running is None:
+        raise ValueError("Error: No reads in {}.".format(", ".join(reader_paths)))
+
+    plate = doe.join(running.table(), on='Well', how='inner')
+    if 'DNA start (s)' in plate:
+        start = plate['DNA start (s)']
+        plate['Time of max rate (h)'] += (start.max() - start) / 3600
+    missing = len(doe) - len(plate)
+    if missing:
+        print("{}: {} design wells are not in the reader export".format(doe_path, missing), file=sys.stderr)
+    return plate
+
+
+def factor_columns(table):
+    """Columns of the factors of the design in a joined table."""
+    return [column for column in table.columns
+            if column not in doe_columns + metrics + ['Plate'] and not column.startswith('Unnamed')]
+
+
+def surface_terms(table, factors):
+    """Coded (-1 to 1) columns of a quadratic response surface: intercept,
+    linear, two-factor interactions and squares of factors with 3 or more
+    levels."""
+    coded = {}
+    for name in factors:
+        low, high = table[name].min(), table[name].max()
+        coded[name] = (table[name] - (low + high) / 2) / ((high - low) / 2 if high > low else 1)
+    terms = {'1': np.ones(len(table))}
+    terms.update((name, coded[name].to_numpy()) for name in factors)
+    terms.update(('{}*{}'.format(a, b), (coded[a] * coded[b]).to_numpy()) for a, b in itertools.combinations(factors, 2))
+    terms.update(('{}^2'.format(name), (coded[name] ** 2).to_numpy()) for name in factors if table[name].nunique() >= 3)
+    return terms
+
+
+def fit_surfaces(wells, factors):
+    """Least squares quadratic response surface of every metric over the
+    factors, fitted on the single wells. One row per metric with the
+    coefficient of every term in coded units, R^2 and the number of wells."""
+    rows = []
+    for metric in metrics:
+        data = wells.dropna(subset=factors + [metric])
+        if data.empty:
+            continue
+        terms = surface_terms(data, factors)
+        X = np.column_stack(list(terms.values()))
+        y = data[metric].to_numpy(float)
+        coef, *_ = np.linalg.lstsq(X, y, rcond=None)
+        residual = y - X @ coef
+        total = ((y - y.mean())**2).sum()
+        row = {'Metric': metric, 'R2': 1 - (residual**2).sum() / total if total > 0 else np.nan, 'n': len(data)}
+        row.update(zip(terms, coef))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--plate', nargs='+', action='append', required=True, metavar='FILE',
+                        help="DOE.csv of a plate and its reader exports in read order, once per plate and run")
+    parser.add_argument('--window', type=int, default=3, help="reads the rate is taken over (default: %(default)s)")
+    parser.add_argument('--chunksize', type=int, default=1000, help="reads held in memory at once (default: %(default)s)")
+    parser.add_argument('--wells', help="write the metrics of every well to this file")
+    parser.add_argument('--surface', help="write the response surface coefficients to this file")
+    parser.add_argument('--output', help="write the metrics of every condition to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    plates = []
+    for i, (doe, *readers) in enumerate(args.plate):
+        if not readers:
+            raise ValueError("Error: --plate {} has no reader export.".format(doe))
+        print("Analysing {} with {}".format(doe, ", ".join(readers)), file=sys.stderr)
+        plate = analyse_plate(doe, readers, args.window, args.chunksize)
+        plate.insert(0, 'Plate', '{}:{}'.format(i + 1, os.path.basename(os.path.dirname(os.path.abspath(doe)))))
+        plates.append(plate)
+    wells = pd.concat(plates, ignore_index=True)
+    factors = factor_columns(wells)
+
+    # Replicates of a condition on all plates and runs
+    conditions = wells.groupby(factors)[metrics].agg(['mean', 'std'])
+    conditions.columns = ['{} {}'.format(metric, stat) for metric, stat in conditions.columns]
+    conditions.insert(0, 'n', wells.groupby(factors).size())
+    conditions.to_csv(args.output or sys.stdout)
+
+    if args.wells:
+        wells.to_csv(args.wells, index=False)
+    surface = fit_surfaces(wells, factors)
+    if args.surface:
+        surface.to_csv(args.surface, index=False)
+    for row in surface.itertuples(index=False):
+        print("Surface {}: R2 {:.3f} over {} wells".format(row.Metric, row.R2, row.n), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""Offline benchmark of the cell-free expression protocols.
+
+Simulates the protocols on the factors.csv/stocks.csv inputs in
+benchmarks/<name>/ and reports the estimated run time, command count, tips,
+gantry travel and reagent use of every run as JSON, so the results of two
+revisions can be diffed. The titration curve reads no fixture and runs once
+per variant. A failing run is reported as a row with its error, and the exit
+status is 1 then. Needs only the opentrons package, no robot.
+
+    python cfe_benchmark.py > before.json
+    python cfe_benchmark.py --variant layout=multichannel --variant route=None > after.json
+
+The number of conditions in DOE.csv is reported too, so variants of the
+experimental design can be weighed against their run time and tips:
+
+    python cfe_benchmark.py --protocol cfe_buffer_optimization.py --variant design_type=full --variant design_type=box-behnken
+
+With --startup it times the cold import of every protocol instead, in a
+fresh interpreter, apart from the import of the Opentrons API itself, and
+lists the heavy libraries the import pulls in:
+
+    python cfe_benchmark.py --startup
+"""
+
+import argparse
+import ast
+import contextlib
+import io
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+here = os.path.dirname(os.path.abspath(__file__))
+protocols = ['cfe_buffer_optimization.py', 'cfe_titration_curve.py']
+fixtures = os.path.join(here, 'benchmarks')
+
+# Simulated robot with the two temperature modules the protocols load, the
+# simulator attaches no modules without it
+hardware_simulator = os.path.join(here, 'simulator.json')
+
+# Run in a fresh interpreter by startup, prints the times as the last line
+startup_code = """
+import importlib.util, json, sys, time
+t0 = time.perf_counter()
+import opentrons.protocol_api
+t1 = time.perf_counter()
+spec = importlib.util.spec_from_file_location('protocol', sys.argv[1])
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+t2 = time.perf_counter()
+print(json.dumps({'opentrons': t1 - t0, 'protocol': t2 - t1,
+                  'heavy_modules': sorted(name for name in ('doepy', 'pandas', 'scipy') if name in sys.modules)}))
+"""
+
+
+def user_inputs(protocol):
+    """Names of the module level settings of a protocol."""
+    with open(os.path.join(here, protocol)) as f:
+        return set(re.findall(r'^(\w+) = ', f.read(), flags=re.M))
+
+
+def reads_fixtures(protocol):
+    """Whether a protocol reads the factors.csv of the fixtures, the
+    titration curve runs on its own inputs."""
+    with open(os.path.join(here, protocol)) as f:
+        return "'factors.csv'" in f.read()
+
+
+def set_inputs(source, settings):
+    """Protocol source with the given user inputs replaced, e.g.
+    {'layout': '"multichannel"'}. Values are Python expressions."""
+    for name, value in settings.items():
+        source, n = re.subn(r'^{} = .*$'.format(re.escape(name)), '{} = {}'.format(name, value), source, count=1, flags=re.M)
+        if n == 0:
+            raise ValueError("Error: The protocol has no user input {}.".format(name))
+    return source
+
+
+def parse_variant(text):
+    """Settings of a variant written as name=value,name=value.
+    Values that are not Python literals are taken as strings."""
+    settings = {}
+    for item in filter(None, text.split(',')):
+        name, value = item.split('=', 1)
+        try:
+            ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            value = repr(value)
+        settings[name.strip()] = value
+    return settings
+
+
+def slot_of(labware):
+    """Deck slot of a labware, also when it sits on a module."""
+    parent = labware.parent
+    return parent if isinstance(parent, str) else parent.parent
+
+
+def reagent_use(runlog):
+    """Volume in muL aspirated from every well nothing is dispensed into,
+    the reagents the run uses up, by slot:well. Mixes are left out."""
+    aspirated = {}
+    filled = set()
+    mix_level = None
+    for entry in runlog:
+        level, payload = entry['level'], entry['payload']
+        if mix_level is not None and level > mix_level:
+            continue
+        mix_level = level if payload['text'].startswith('Mixing') else None
+        location = payload.get('location')
+        if mix_level is not None or location is None or 'volume' not in payload:
+            continue
+        well = location.labware.as_well() if hasattr(location, 'labware') else location
+        name = '{}:{}'.format(slot_of(well.parent), well.well_name)
+        if payload['text'].startswith('Aspirating'):
+            aspirated[name] = aspirated.get(name, 0) + payload['volume']
+        elif payload['text'].startswith('Dispensing'):
+            filled.add(name)
+    return {name: round(volume, 1) for name, volume in sorted(aspirated.items()) if name not in filled}
+
+
+def simulate(protocol, fixture, settings, seed=None):
+    """Simulate one protocol on one fixture, None for none, and sum up the
+    timing log. seed replaces the seed input of a protocol that has one,
+    None keeps the protocol's own."""
+    from opentrons.protocols.duration import DurationEstimator
+    from opentrons.simulate import simulate as simulate_protocol
+
+    inputs = dict(settings)
+    if seed is not None and 'seed' in user_inputs(protocol):
+        inputs['seed'] = seed
+    with open(os.path.join(here, protocol)) as f:
+        source = set_inputs(f.read(), inputs)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as run_dir:
+        for name in ('factors.csv', 'stocks.csv') if fixture else ():
+            with open(os.path.join(fixture, name)) as src, open(os.path.join(run_dir, name), 'w') as dst:
+                dst.write(src.read())
+        os.chdir(run_dir)
+        try:
+            estimator = DurationEstimator()
+            # Keep what the protocol prints out of the results on stdout
+            with contextlib.redirect_stdout(sys.stderr):
+                runlog, _ = simulate_protocol(io.StringIO(source), file_name=protocol, duration_estimator=estimator,
+                                              hardware_simulator_file_path=hardware_simulator)
+            with open('timing.jsonl') as f:
+                lines = [json.loads(line) for line in f]
+            conditions = None
+            if os.path.exists('DOE.csv'):
+                with open('DOE.csv') as f:
+                    conditions = sum(1 for line in f) - 1
+        finally:
+            os.chdir(cwd)
+
+    phases = {}
+    for line in lines:
+        if line['type'] == 'phase':
+            phases[line['phase']] = {key: round(line[key], 1) for key in ('commands', 'tips', 'aspirations', 'dispenses', 'travel')}
+    return {
+        'protocol': protocol,
+        'fixture': fixture and os.path.basename(fixture),
+        'variant': settings,
+        'conditions': conditions,
+        'duration': round(estimator.get_total_duration(), 1),
+        'commands': sum(phase['commands'] for phase in phases.values()),
+        'tips': sum(phase['tips'] for phase in phases.values()),
+        'travel': round(sum(phase['travel'] for phase in phases.values()), 1),
+        'phases': phases,
+        'reagents': reagent_use(runlog),
+    }
+
+
+def startup(protocol, repeat=5):
+    """Fastest of repeat cold imports of a protocol, in s."""
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', startup_code, os.path.join(here, protocol)], cwd=here,
+                                stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+    return {
+        'protocol': protocol,
+        'opentrons_import': round(min(run['opentrons'] for run in runs), 3),
+        'protocol_import': round(min(run['protocol'] for run in runs), 3),
+        'heavy_modules': runs[0]['heavy_modules'],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--protocol', action='append', help="protocol file (default: both protocols)")
+    parser.add_argument('--fixture', action='append', help="directory with factors.csv and stocks.csv (default: all in benchmarks/)")
+    parser.add_argument('--variant', action='append', help="user inputs to change, e.g. route=serpentine,design_type=box-behnken")
+    parser.add_argument('--seed', type=int, help="seed of the random plate design (default: the protocol's seed input)")
+    parser.add_argument('--startup', action='store_true', help="time the cold import of the protocols instead")
+    parser.add_argument('--output', help="write the results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    # The protocols import the cfe_* helpers next to them
+    sys.path.insert(0, here)
+    fixture_dirs = args.fixture or sorted(os.path.join(fixtures, name) for name in os.listdir(fixtures))
+    variants = [parse_variant(text) for text in args.variant or ['']]
+
+    # A run that fails is reported as a row with its error, the others go on
+    results = []
+    for protocol in args.protocol or protocols:
+        if args.startup:
+            print("Timing the import of {}".format(protocol), file=sys.stderr)
+            try:
+                results.append(startup(protocol))
+            except subprocess.CalledProcessError as e:
+                results.append({'protocol': protocol, 'error': str(e)})
+            continue
+        for fixture in fixture_dirs if reads_fixtures(protocol) else [None]:
+            name = os.path.basename(fixture) if fixture else "its own inputs"
+            for settings in variants:
+                if not user_inputs(protocol).issuperset(settings):
+                    print("Skipping {} on {}, it has no input {}".format(protocol, name, ", ".join(set(settings) - user_inputs(protocol))), file=sys.stderr)
+                    continue
+                print("Simulating {} on {} {}".format(protocol, name, settings), file=sys.stderr)
+                try:
+                    results.append(simulate(protocol, fixture, settings, args.seed))
+                except Exception as e:
+                    print("Failed: {}".format(e), file=sys.stderr)
+                    results.append({'protocol': protocol, 'fixture': fixture and os.path.basename(fixture),
+                                    'variant': settings, 'error': str(e)})
+
+    text = json.dumps(results, indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+    return 1 if any('error' in result for result in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
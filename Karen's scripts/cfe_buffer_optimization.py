@@ -1,7 +1,21 @@
 from opentrons import protocol_api
-from doepy import build
-from math import ceil
-import pandas as pd
+from opentrons.types import Location, Point
+from itertools import product
+from math import ceil, hypot
+import numpy as np
+import csv
+import hashlib
+import json
+import os
+import sys
+import types
+
+from cfe_ledger import Ledger, as_well, channel_wells
+from cfe_router import Router
+from cfe_schedule import distribute_times, schedule, skew
+from cfe_temperature import ColdBlocks
+from cfe_volumes import intermediate_volumes, solve_dilutions
+from cfe_timing import TimingLog
 
 metadata = {
     'apiLevel': '2.8',
@@ -9,13 +23,461 @@ metadata = {
     'description': '''This protocol is for setting up a range 
     of different buffer compositions to optimize the buffer
     solution for the cell-free expression. It takes the premix and adds
-    of Mg-glutamate, K-glutamate and PEG8000. In total 343 combinations are tested.''',
+    of Mg-glutamate, K-glutamate and PEG8000. In total 343 combinations are tested
+    with the full factorial design.''',
     'author': 'Karen Therkelsen (s173684@dtu.dk)',
 }
 
-nsamples = 343 + 1
+## User inputs
+
+# Order of the wells in every distribute to the plate: "2-opt" (nearest
+# neighbour route shortened by 2-opt), "serpentine" or None for plate order
+route = "2-opt"
+
+# Cooling of the temperature modules to 4 C: "overlap" starts both modules at
+# once and waits only before the first step on a cooled block, "serial" cools
+# them one after the other before the run
+cooling = "overlap"
+
+# Limit in s on the spread of the DNA start times over the plate. The DNA is
+# added faster (no touch tip, then one mix) when needed; None only reports it
+dna_skew_limit = None
+
+# Experimental design over the levels in factors.csv: "full" factorial,
+# "fractional" factorial (2 levels), "box-behnken" (3 levels), "ccd" (face
+# centred central composite, 3 levels) or "lhs" (space filling Latin
+# hypercube of lhs_samples conditions). The reduced designs screen 4-6
+# factors on one plate, one column of factors.csv per factor
+design_type = "full"
+lhs_samples = 50
+
+# Volumes in muL loaded into the source tubes before the run, by reagent:
+# MQ, DNA, BufferW, Lysate or a factor for its stock. The plan fails if it
+# draws one of them dry; the others are reported with the volume to load
+start_volumes = {'MQ': 2000}
+
+# Seed of the random plate design, the same seed and inputs give the same
+# plan, which is cached in plan_cache/. None makes a new design every run
+seed = 1
+
+####################################################################################
+
+
+def read_columns(path):
+    """Columns of a small CSV file such as factors.csv or stocks.csv as
+    {header: [numbers]}, empty cells left out. Reads it without pandas so
+    the protocol starts fast."""
+    with open(path, newline='') as f:
+        rows = list(csv.reader(f))
+    return {name: [float(row[i]) for row in rows[1:] if i < len(row) and row[i].strip()]
+            for i, name in enumerate(rows[0])}
+
+
+def make_design(factors, method="full", samples=50, seed=None):
+    """Experimental design over the levels in the {factor: levels} dict
+    factors, as a pandas table. The reduced designs take the lowest and
+    highest level, and the middle one for Box-Behnken. Full, fractional
+    and Box-Behnken designs must give conditions on the levels. Central
+    composite and Latin hypercube conditions must lie between the lowest and
+    highest level and are set to the nearest level in factors so they can
+    be pipetted from the dilutions; Latin hypercube conditions that end up
+    the same are merged. The designs are mapped from the coded matrices of
+    doepy here, its own tables hold level indices under pandas 3."""
+    # doepy and pandas take long to import, only load them to build a design
+    import pandas as pd
+    from doepy.pydoe_corrected import bbdesign_corrected, ccdesign_corrected, fracfact_by_res
+
+    levels = {name: sorted(set(values)) for name, values in factors.items()}
+    names = list(levels)
+    if method == "full":
+        # The first factor changes fastest, in the order of doepy's full_fact
+        rows = [row[::-1] for row in product(*[levels[name] for name in names[::-1]])]
+        return pd.DataFrame(rows, columns=names, dtype=float)
+    # Coded values of the generator and the levels they stand for
+    corners = {name: [lst[0], lst[-1]] for name, lst in levels.items()}
+    if method == "fractional":
+        coded, coding, values = fracfact_by_res(len(names), len(names)//2 + 1), [-1, 1], corners
+    elif method == "box-behnken":
+        centred = {name: [lst[0], lst[len(lst)//2], lst[-1]] for name, lst in levels.items()}
+        coded, coding, values = bbdesign_corrected(len(names), center=1), [-1, 0, 1], centred
+    elif method == "ccd":
+        coded, coding, values = ccdesign_corrected(len(names), center=(2, 2), alpha='o', face='ccf'), [-1, 1], corners
+    elif method == "lhs":
+        from diversipy import lhd_matrix, transform_spread_out
+        if seed is not None:
+            np.random.seed(seed)
+        coded, coding, values = transform_spread_out(lhd_matrix(num_points=samples, dimension=len(names))), [0, 1], corners
+    else:
+        raise ValueError("Error: Unknown design {}.".format(method))
+    if coded.min() < coding[0] or coded.max() > coding[-1]:
+        raise ValueError("Error: The {} design has coded values outside [{}, {}].".format(method, coding[0], coding[-1]))
+    design = pd.DataFrame({name: np.interp(coded[:, i], coding, values[name]) for i, name in enumerate(names)})
+
+    # A generator that goes wrong must not be hidden by setting its
+    # conditions to the nearest level
+    for name, lst in levels.items():
+        wrong = [value for value in design[name] if not np.isclose(value, lst).any()]
+        if wrong and method in ("fractional", "box-behnken"):
+            raise ValueError("Error: The {} design sets {} to {:g}, off its levels {}.".format(method, name, wrong[0], lst))
+        design[name] = [min(lst, key=lambda level: abs(level - value)) for value in design[name]]
+    if method == "lhs":
+        design = design.drop_duplicates().reset_index(drop=True)
+    return design
+
+
+def index_design(design, factor_names):
+    """Group the plate wells of the design by factor level.
+    Maps every (factor, level) to the sorted list of wells loaded with
+    that level. Built once with one grouping pass per factor."""
+    index = {}
+    for factor in factor_names:
+        for level, wells in design.groupby(factor, sort=False)['Well']:
+            index[(factor, level)] = sorted(wells.tolist())
+    return index
+
+
+def design_levels(index, factor):
+    """Sorted levels of a factor in the design index. Position in the
+    list is the column of the factor's dilution in the PCR strips."""
+    return sorted(level for name, level in index if name == factor)
+
+
+def well_name(well, nrows=16):
+    """Name of a plate well from its position in plate.wells()."""
+    return "{}{}".format("ABCDEFGHIJKLMNOP"[well % nrows], well // nrows + 1)
+
+
+def well_position(well, nrows=16, pitch=4.5):
+    """x, y position in mm of a plate well relative to A1."""
+    return (well // nrows) * pitch, (well % nrows) * pitch
+
+
+def route_length(wells):
+    """Gantry travel in mm to visit the plate wells in the given order."""
+    points = [well_position(well) for well in wells]
+    return sum(hypot(x1-x0, y1-y0) for (x0, y0), (x1, y1) in zip(points, points[1:]))
+
+
+def order_route(wells, method="2-opt", nrows=16, max_passes=20):
+    """Order plate wells into a short gantry route. Only the order of the
+    visits changes, not which wells are loaded.
+    "serpentine" goes down a column and up the next one, "2-opt" starts from
+    a nearest neighbour route and reverses segments while that shortens it."""
+    wells = list(wells)
+    if method == "serpentine":
+        return sorted(wells, key=lambda well: (well // nrows, (well % nrows) * (-1)**(well // nrows)))
+    if method != "2-opt":
+        raise ValueError("Error: Unknown route method {}.".format(method))
+    if len(wells) < 3:
+        return sorted(wells)
+
+    points = {well: well_position(well, nrows) for well in wells}
+    def dist(a, b):
+        return hypot(points[a][0]-points[b][0], points[a][1]-points[b][1])
+
+    # Nearest neighbour route from the first well in plate order
+    left = set(wells)
+    path = [min(wells)]
+    left.remove(path[0])
+    while left:
+        nearest = min(left, key=lambda well: (dist(path[-1], well), well))
+        path.append(nearest)
+        left.remove(nearest)
+
+    # 2-opt on the open path, the first well stays in place
+    n = len(path)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(n - 2):
+            a, b = path[i], path[i+1]
+            for j in range(i + 2, n):
+                c = path[j]
+                if j + 1 < n:
+                    d = path[j+1]
+                    delta = dist(a, c) + dist(b, d) - dist(a, b) - dist(c, d)
+                else:
+                    delta = dist(a, c) - dist(a, b)
+                if delta < -1e-9:
+                    path[i+1:j+1] = path[i+1:j+1][::-1]
+                    b = path[i+1]
+                    improved = True
+        if not improved:
+            break
+    return path
+
+
+def as_wells(target):
+    """Wells of a well, location or list of them."""
+    targets = target if isinstance(target, (list, tuple)) else [target]
+    return [t.labware.as_well() if isinstance(t, Location) else t for t in targets]
+
+
+class PlannedPipette:
+    """Pipette that records its commands in a plan instead of moving."""
+
+    def __init__(self, plan, pipette):
+        self.plan = plan
+        self.pipette = pipette
+
+    def transfer(self, *args, **kwargs):
+        self.plan.steps.append((self.pipette, 'transfer', args, kwargs))
+
+    def distribute(self, *args, **kwargs):
+        self.plan.steps.append((self.pipette, 'distribute', args, kwargs))
+
+    def pick_up_tip(self, *args, **kwargs):
+        self.plan.steps.append((self.pipette, 'pick_up_tip', args, kwargs))
+
+    def drop_tip(self, *args, **kwargs):
+        self.plan.steps.append((self.pipette, 'drop_tip', args, kwargs))
+
+    def aspirate(self, *args, **kwargs):
+        self.plan.steps.append((self.pipette, 'aspirate', args, kwargs))
+
+    def dispense(self, *args, **kwargs):
+        self.plan.steps.append((self.pipette, 'dispense', args, kwargs))
+
+    def mix(self, *args, **kwargs):
+        self.plan.steps.append((self.pipette, 'mix', args, kwargs))
+
+    def set_flow_rate(self, aspirate, dispense):
+        self.plan.steps.append((self.pipette, 'set_flow_rate', (aspirate, dispense), {}))
+
+
+class Plan:
+    """Pipette commands of a run, recorded before the robot moves so the
+    tips can be counted and the racks loaded up front."""
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.steps = []
+
+    def record(self, pipette):
+        """Planned stand-in for a loaded pipette."""
+        return PlannedPipette(self, pipette)
+
+    def comment(self, text):
+        self.steps.append((None, 'comment', (text,), {}))
+
+    def phase(self, name):
+        """Mark the start of a phase of the run for the timing log."""
+        self.steps.append((None, 'phase', (name,), {}))
+
+    def share_tips(self):
+        """Let consecutive transfers of a pipette from the same source into
+        wells nothing has been dispensed to yet share one tip. The tip only
+        touches the source and clean wells, so nothing is carried over."""
+        steps = []
+        touched = set()
+        run = []
+
+        def close_run():
+            if len(run) > 1:
+                pipette = run[0][0]
+                steps.append((pipette, 'pick_up_tip', (), {}))
+                steps.extend((pipette, method, args, dict(kwargs, new_tip='never')) for pipette, method, args, kwargs in run)
+                steps.append((pipette, 'drop_tip', (), {}))
+            else:
+                steps.extend(run)
+            del run[:]
+
+        for step in self.steps:
+            pipette, method, args, kwargs = step
+            dests = as_wells(args[2]) if method in ('transfer', 'distribute') else []
+            shareable = (method == 'transfer' and kwargs.get('new_tip', 'once') == 'once'
+                         and 'mix_before' not in kwargs and 'mix_after' not in kwargs
+                         and not isinstance(args[1], (list, tuple))
+                         and not touched.intersection(dests))
+            if run and not (shareable and pipette is run[0][0] and args[1] is run[0][2][1]):
+                close_run()
+            if shareable:
+                run.append(step)
+            else:
+                steps.append(step)
+            touched.update(dests)
+            if method == 'dispense':
+                touched.update(as_wells(args[1]))
+        close_run()
+        self.steps = steps
+
+    def track_volumes(self, ledger):
+        """Follow the liquid of every step in the ledger, which fails if a
+        well runs dry. Plain wells of known volume are aspirated from just
+        below the meniscus and dispensed to just above it instead of at
+        the bottom."""
+        steps = []
+        for pipette, method, args, kwargs in self.steps:
+            if method in ('transfer', 'distribute'):
+                args = (args[0], ledger.transfer(pipette.channels, *args[:3])) + tuple(args[2:])
+            elif method in ('aspirate', 'dispense'):
+                volume, target = args[:2]
+                for well in channel_wells(as_well(target), pipette.channels):
+                    getattr(ledger, method)(well, volume)
+                if isinstance(target, protocol_api.Well):
+                    located = getattr(ledger, method + '_location')(target)
+                    args = (volume, located or target) + tuple(args[2:])
+            steps.append((pipette, method, args, kwargs))
+        self.steps = steps
+
+    def tips(self):
+        """Number of tips each pipette picks up in the plan."""
+        tips = {}
+        for pipette, method, args, kwargs in self.steps:
+            if method == 'pick_up_tip':
+                tips[pipette] = tips.get(pipette, 0) + 1
+            elif method in ('transfer', 'distribute'):
+                new_tip = kwargs.get('new_tip', 'once')
+                if new_tip == 'once':
+                    tips[pipette] = tips.get(pipette, 0) + 1
+                elif new_tip == 'always':
+                    tips[pipette] = tips.get(pipette, 0) + len(as_wells(args[2]))
+        return tips
+
+    def load_tip_racks(self):
+        """Load tip racks into free deck slots until every pipette has
+        the tips of the plan. Fails before the robot moves if the deck
+        cannot hold them."""
+        free_slots = [slot for slot in range(1, 12) if self.protocol.deck[slot] is None]
+        for pipette, tips in self.tips().items():
+            per_rack = 96 // pipette.channels
+            racks = -(-tips // per_rack) - len(pipette.tip_racks)
+            if racks > len(free_slots):
+                raise RuntimeError("Error: {} needs {} tips but the deck has no free slot for {} of its tip racks.".format(pipette.name, tips, racks - len(free_slots)))
+            added = [self.protocol.load_labware(pipette.tip_racks[0].load_name, free_slots.pop(0)) for _ in range(racks)]
+            pipette.tip_racks = pipette.tip_racks + added
+            self.protocol.comment("Tips: {} uses {} tips in {} racks".format(pipette.name, tips, len(pipette.tip_racks)))
+
+    def execute(self, timing=None, cold=None):
+        for pipette, method, args, kwargs in self.steps:
+            if cold is not None:
+                cold.touch(*args, *kwargs.values())
+            if method == 'comment':
+                self.protocol.comment(*args)
+            elif method == 'phase':
+                if timing is not None:
+                    timing.phase(*args)
+            elif method == 'set_flow_rate':
+                pipette.flow_rate.aspirate, pipette.flow_rate.dispense = args
+            else:
+                getattr(pipette, method)(*args, **kwargs)
+
+    def save(self, path, doe):
+        """Write the steps and the design export to a JSON file."""
+        slots = {labware: slot for slot, labware in self.protocol.loaded_labwares.items()}
+        steps = [[None if pipette is None else pipette.mount, method, encode(list(args), slots), encode(kwargs, slots)]
+                 for pipette, method, args, kwargs in self.steps]
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'steps': steps, 'doe': doe}, f)
+
+    def load(self, path):
+        """Read the steps of a saved plan, returns its design export."""
+        with open(path) as f:
+            saved = json.load(f)
+        pipettes = self.protocol.loaded_instruments
+        self.steps = [(None if mount is None else pipettes[mount], method, tuple(decode(args, self.protocol)), decode(kwargs, self.protocol))
+                      for mount, method, args, kwargs in saved['steps']]
+        return saved['doe']
+
+
+def encode(value, slots):
+    """JSON form of a plan step argument. Wells are kept as slot and well
+    name, locations relative to the bottom of their well."""
+    if isinstance(value, Location):
+        well = value.labware.as_well()
+        offset = value.point - well.bottom().point
+        return {'location': [slots[well.parent], well.well_name, offset.x, offset.y, offset.z]}
+    if isinstance(value, protocol_api.Well):
+        return {'well': [slots[value.parent], value.well_name]}
+    if isinstance(value, tuple):
+        return {'tuple': [encode(v, slots) for v in value]}
+    if isinstance(value, list):
+        return [encode(v, slots) for v in value]
+    if isinstance(value, dict):
+        return {'dict': {k: encode(v, slots) for k, v in value.items()}}
+    if hasattr(value, 'item'):    # numpy number
+        return value.item()
+    return value
+
+
+def decode(value, protocol):
+    """Plan step argument from its JSON form."""
+    if isinstance(value, list):
+        return [decode(v, protocol) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if 'location' in value:
+        slot, name, x, y, z = value['location']
+        return protocol.loaded_labwares[slot][name].bottom().move(Point(x, y, z))
+    if 'well' in value:
+        slot, name = value['well']
+        return protocol.loaded_labwares[slot][name]
+    if 'tuple' in value:
+        return tuple(decode(v, protocol) for v in value['tuple'])
+    return {k: decode(v, protocol) for k, v in value['dict'].items()}
+
+
+def code_digest(code, digest):
+    """Add the bytecode and constants of a function to a hash, without its
+    file name and line numbers. Bytecode differs between Python versions,
+    the caller adds the version to the hash."""
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if hasattr(const, 'co_code'):
+            code_digest(const, digest)
+        else:
+            digest.update(repr(const).encode())
+
+
+def helper_modules(namespace):
+    """cfe_* modules the namespace uses, directly or through other cfe_*
+    modules, by name."""
+    found = {}
+    todo = [namespace]
+    while todo:
+        for obj in list(todo.pop().values()):
+            name = obj.__name__ if isinstance(obj, types.ModuleType) else getattr(obj, '__module__', None)
+            if isinstance(name, str) and name.startswith('cfe_') and name not in found and name in sys.modules:
+                found[name] = sys.modules[name]
+                todo.append(vars(found[name]))
+    return found
+
+
+def plan_key(paths, settings, namespace):
+    """Hash of everything a plan depends on: the input files, the user
+    settings, the source files of the cfe_* helper modules, and the
+    constants and code of the functions and classes in the namespace of the
+    protocol. The protocol is run from a string, so its code is hashed as
+    bytecode with the Python version; a plan compiled under another Python
+    version, e.g. on a laptop for the robot, is compiled again."""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    digest.update(repr(sorted(settings.items())).encode())
+    modules = helper_modules(namespace)
+    for name, module in sorted(modules.items()):
+        with open(module.__file__, 'rb') as f:
+            digest.update(name.encode() + f.read().replace(b'\r\n', b'\n'))
+    digest.update(repr(sys.version_info[:2]).encode())
+    for name, obj in sorted(namespace.items()):
+        if getattr(obj, '__module__', None) in modules:
+            continue
+        if isinstance(obj, (bool, int, float, str, list, tuple, dict)) and not name.startswith('__'):
+            digest.update(repr((name, obj)).encode())
+        members = list(vars(obj).values()) if isinstance(obj, type) else [obj]
+        for member in members:
+            if hasattr(member, '__code__'):
+                code_digest(member.__code__, digest)
+    return digest.hexdigest()
+
 
 def run(protocol):
+
+    # Time every phase and pipette command of the run, see timing.jsonl
+    timing = TimingLog(protocol)
+    timing.phase("planning")
     
     ## Load instrument, modules and labware ##
 
@@ -33,6 +495,8 @@ def run(protocol):
     #              #              #              #
     #------------- #------------- #------------- #
 
+    # Extra tip racks the run needs are loaded to the free slots
+
 
     # Pipettes and tips
     tips20 = protocol.load_labware('opentrons_96_tiprack_20ul', 8)
@@ -40,6 +504,9 @@ def run(protocol):
     p20 = protocol.load_instrument('p20_single_gen2', mount='left', tip_racks=[tips20])
     p300 = protocol.load_instrument('p300_single_gen2', mount='right', tip_racks=[tips300])
 
+    # Commands are planned before they run
+    plan = Plan(protocol)
+    p20, p300 = plan.record(p20), plan.record(p300)
 
     # 384-well plate
     plate = protocol.load_labware('corning_384_wellplate_112ul_flat', 11)
@@ -50,11 +517,13 @@ def run(protocol):
     # Temperature modules
     temp_module_pcrtubes = protocol.load_module('temperature module gen2', 10)
     pcrtubes_cool = temp_module_pcrtubes.load_labware('opentrons_96_aluminumblock_generic_pcr_strip_200ul')
-    temp_module_pcrtubes.set_temperature(4)
 
     temp_module_eppendorftubes = protocol.load_module('temperature module gen2', 7)
     eppendorftubes_cool = temp_module_eppendorftubes.load_labware('opentrons_24_aluminumblock_nest_2ml_snapcap')
-    temp_module_eppendorftubes.set_temperature(4)  
+
+    # Cooled once the plan is checked, the run waits for a module at its
+    # first step on it
+    cold = ColdBlocks([temp_module_pcrtubes, temp_module_eppendorftubes], 4, cooling)
     
     ## Define start reagents
 
@@ -64,258 +533,345 @@ def run(protocol):
     Lysate = eppendorftubes_cool.wells_by_name()["C6"]       # X mL
     MQ = eppendorftubes_cool.wells_by_name()["D6"]           # 2 mL
     
-    # In PCR module
-    Mg_glut = pcrtubes_cool.wells_by_name()["A8"]      # X muL 1M
-    K_glut = pcrtubes_cool.wells_by_name()["B8"]       # X muL 2M
-    PEG8000 = pcrtubes_cool.wells_by_name()["C8"]      # muL 40%
+    # In PCR module, the stock of every factor in column 8, one row per factor
+    # in the order of factors.csv: Mg-glutamate A8 1M, K-glutamate B8 2M,
+    # PEG-8000 C8 40%, then D8, E8 and F8 for the other factors. A stock the
+    # run needs more than 200 muL of goes in row A of the Eppendorf module
+    # instead (A1 for the first factor), the run starts with a comment
 
     # In rack
     MM = rack.wells_by_name()["A1"]
 
-    def find_index(lst,item):
-        if item in lst:
-            return lst.index(item)
-        else:
-            return None   
-
-    def sorted_factors_to_lst(factors,reagent):
-        """Extract factor values from pandas dataframe.
-        Input is a string with name of reagent and outputs a sorted list"""
-        lst = factors[reagent].tolist()
-        lst.sort()
-        return lst
-
-    def pipette_vicious(mode):
-        """Decrease flow rate for pipettes suitable for vicous liquids."""
-        if mode == 0:     # OFF
-                p20.flow_rate.aspirate = 7.56
-                p20.flow_rate.dispense = 7.56
-                p300.flow_rate.aspirate = 92.86
-                p300.flow_rate.dispense = 92.86
-        if mode == 1:     # ON
-                p20.flow_rate.aspirate = 2
-                p20.flow_rate.dispense = 2
-                p300.flow_rate.aspirate = 10
-                p300.flow_rate.dispense = 10
-
-    def load_control(factors):
+    ## Dilutions and volumes loaded to each well
+
+    # Factors to optimize are the columns of factors.csv. Factors other than
+    # the three below load 0.5 muL of a dilution 20 times the well
+    # concentration of the reference reaction
+    factor_names = list(read_columns('factors.csv'))
+    if len(factor_names) > 6:
+        raise ValueError("Error: {} factors in factors.csv, the PCR strips hold the dilutions of 6.".format(len(factor_names)))
+    load_vol = {'Mg-glutamate': 0.5, 'K-glutamate': 0.75, 'PEG-8000': 1.5}    # muL
+    load_vol = {name: load_vol.get(name, 0.5) for name in factor_names}
+    dilution_wells = {name: pcrtubes_cool.rows()[i] for i, name in enumerate(factor_names)}
+    dilution_vol = {name: 30 for name in factor_names}    # muL
+    dead_vol = 2    # muL left in source tubes
+
+    stocks = {name: pcrtubes_cool.rows()[i][7] for i, name in enumerate(factor_names)}
+    # The reference reaction, 7 muL lysate and buffer, 0.5 muL DNA and the
+    # three factors above, holds 10.25 muL. More factors make a larger
+    # reaction, where lysate, buffer and DNA keep their share and the
+    # dilution factors scale with the volume; less factors leave room that
+    # MilliQ in the mastermix fills. So every well gets the concentrations
+    # in DOE.csv
+    reference_vol = 10.25    # muL
+    scale = max(1, round(sum(load_vol.values()) / (reference_vol - 7 - 0.5), 4))
+    water_vol = max(0, round((reference_vol - 7 - 0.5) * scale - sum(load_vol.values()), 2))    # muL per well
+    mm_vol = round(7 * scale + water_vol, 2)    # muL per well
+    dna_vol = round(0.5 * scale, 2)    # muL per well
+    dil_factor = {'Mg-glutamate': 20, 'K-glutamate': 13, 'PEG-8000': 6.66}    # stock to well concentration
+    dil_factor = {name: dil_factor.get(name, 10 / load_vol[name]) * scale for name in factor_names}
+
+    # Reference concentrations of the control, diluted to control_vol
+    # when the design has no such level
+    reference = {'Mg-glutamate': 3, 'K-glutamate': 60, 'PEG-8000': 2}
+    control_vol = 10    # muL
+
+    ## Liquid classes, flow rates (muL/s) by pipette max volume
+    liquid_classes = {
+        'water': {'flow_rate': {20: (7.56, 7.56), 300: (92.86, 92.86)}, 'options': {'touch_tip': True, 'blow_out': True, 'blowout_location': 'source well'}},
+        'stock': {'flow_rate': {20: (7.56, 7.56), 300: (92.86, 92.86)}, 'options': {'touch_tip': True, 'mix_after': (5,15)}},
+        'viscous': {'flow_rate': {20: (2, 2), 300: (10, 10)}, 'options': {'touch_tip': True, 'blow_out': True, 'blowout_location': 'source well'}},
+        'viscous_stock': {'flow_rate': {20: (2, 2), 300: (10, 10)}, 'options': {'touch_tip': True, 'mix_after': (5,15)}},
+    }
+    stock_class = {name: 'viscous_stock' if name == 'PEG-8000' else 'stock' for name in factor_names}
+    load_class = {name: 'viscous' if name == 'PEG-8000' else 'water' for name in factor_names}
+    router = Router({20: p20, 300: p300}, liquid_classes, 'water')
+
+    def plan_route(wells, label):
+        """Order plate wells into a short gantry route and report
+        the travel before and after."""
+        wells = list(wells)
+        ordered = order_route(wells, route) if route else wells
+        plan.comment("Route {}: {} wells, {:.0f} mm -> {:.0f} mm".format(label, len(wells), route_length(wells), route_length(ordered)))
+        return [plate.wells()[well] for well in ordered]
+
+    # Sorted levels of every factor in the design, set when the design is built
+    levels = {}
+
+    def dilution_well(name, level):
+        """Dilution of a factor level, in the order of the design levels."""
+        return dilution_wells[name][levels[name].index(level)]
+
+    # Tubes of the PCR strips given out for extra dilutions, and the
+    # dilution of the reference level of the control made by factors_dilution
+    taken = []
+    control_dilutions = {}
+
+    def spare_tube(i, name):
+        """Free tube for an extra dilution of the i-th factor, in the
+        factor's row after its dilutions or else in column 9."""
+        for well in pcrtubes_cool.rows()[i][:7] + pcrtubes_cool.columns()[8]:
+            if well not in dilution_wells[name][:len(levels[name])] and well not in taken:
+                taken.append(well)
+                return well
+        raise ValueError("Error: No free tube for an extra dilution of {}.".format(name))
+
+    def load_control(control_well):
         """Load internal control wo/ DNA to well plate 
-        w/ 3 mM Mg-glutamate, 60 mM K-glutamate, and 2% PEG-8000"""
+        w/ 3 mM Mg-glutamate, 60 mM K-glutamate, and 2% PEG-8000.
+        Other factors are replaced by MilliQ."""
 
         # No DNA
-        p20.transfer(0.5, MQ, plate.wells()[nsamples], touch_tip=True)
+        ops = [(MQ, control_well, dna_vol, 'water')]
 
         # Add reference factors
-        Mg_final_conc = sorted_factors_to_lst(factors,'Mg-glutamate')
-        K_final_conc = sorted_factors_to_lst(factors,'K-glutamate')
-        P_final_conc = sorted_factors_to_lst(factors,'PEG-8000')
-        if find_index(Mg_final_conc,3) is not None:
-            dil_well = "A{}".format(find_index(Mg_final_conc,3)+1)
-            p20.transfer(0.5, pcrtubes_cool.wells_by_name()[dil_well], plate.wells()[nsamples], touch_tip=True)
-        else:
-            # Make dilution and add to well
-            p20.transfer(0.6, Mg_glut, pcrtubes_cool.wells_by_name()['C1'], touch_tip=True)
-            p20.transfer(9.4, MQ, pcrtubes_cool.wells_by_name()['C1'], touch_tip=True)
-            p20.transfer(0.5, pcrtubes_cool.wells_by_name()['C1'], plate.wells()[nsamples], touch_tip=True)
-        if find_index(K_final_conc,60) is not None:
-            dil_well = "B{}".format(find_index(K_final_conc,60)+1)
-            p20.transfer(0.75, pcrtubes_cool.wells_by_name()[dil_well], plate.wells()[nsamples], touch_tip=True)
-        else:
-            # Make dilution and add to well
-            p20.transfer(4, K_glut, pcrtubes_cool.wells_by_name()['C2'], touch_tip=True)
-            p20.transfer(6, MQ, pcrtubes_cool.wells_by_name()['C2'], touch_tip=True)
-            p20.transfer(0.75, pcrtubes_cool.wells_by_name()['C2'], plate.wells()[nsamples], touch_tip=True)
-        if find_index(P_final_conc,2) is not None:
-            dil_well = "C{}".format(find_index(P_final_conc,2)+1)
-            p20.transfer(1.5, pcrtubes_cool.wells_by_name()[dil_well], plate.wells()[nsamples], touch_tip=True)
-        else:
-            # Make dilution and add to well
-            p20.transfer(3.3, PEG8000, pcrtubes_cool.wells_by_name()['C3'], touch_tip=True)
-            p20.transfer(6.6, MQ, pcrtubes_cool.wells_by_name()['C3'], touch_tip=True)
-            p20.transfer(1.5, pcrtubes_cool.wells_by_name()['C3'], plate.wells()[nsamples], touch_tip=True)
+        for name in factor_names:
+            if name not in reference:
+                ops.append((MQ, control_well, load_vol[name], 'water'))
+                continue
+            dil_well = control_dilutions.get(name) or dilution_well(name, reference[name])
+            ops.append((dil_well, control_well, load_vol[name], load_class[name]))
+        router.route(ops)
+
+    def factors_dilution(design):
+        """Make dilutions of the levels of every factor in the design,
+        e.g. Mg-glut, K-glut and PEG-8000, and of the reference level of
+        the control the design lacks. A dilution holds at least
+        dilution_vol, more when the wells it is loaded to need it. The
+        volumes of all dilutions are solved at once; stock volumes below
+        0.5 muL come from an intermediate dilution of the stock. MilliQ goes
+        in first, then the stock solution is added and mixed in."""
         
-    def calc_volume(reagent, final_conc_lst, stock_conc, final_vol, dil_factor):
-        """
-        Calculate volumes of reagent stock/dilution to get final concentration.
-        Takes in a list of final concentrations, final volume, name of reagent and dilution factor
-        and outputs two lists with volumes of stock/dilution and MilliQ.
-        """
-        reagent_vol_lst = []
-        mq_vol_lst = []
-        for i in range(len(final_conc_lst)):
-            vol = ((final_conc_lst[i]*dil_factor)*final_vol)/stock_conc
-            if vol > final_vol:
-                raise ValueError("Error: Stock volume exceeds 30 muL. Change {} stock concentration.".format(reagent))
-            elif vol < 0.5 and vol != 0:
-                raise ValueError("Error: Stock volume lower than minimum required volume 0.5 muL. Change {} stock concentration.".format(reagent))
-            else:
-                if final_vol == ceil(vol):
-                    reagent_vol_lst.append(ceil(vol))
-                    mq_vol_lst.append(0)
-                else:
-                    if final_vol-vol < 0.5:
-                        raise ValueError("Error: MilliQ volume lower than minimum required volume 0.5 muL. Change {} stock concentration.".format(reagent))
-                    else:
-                        reagent_vol_lst.append(vol)
-                        mq_vol_lst.append(final_vol-vol)
-        return reagent_vol_lst, mq_vol_lst
-
-    def factors_dilution(factors):
-        """Make dilutions of Mg-glut, Mg-glut and PEG-8000
-        based on csv file input."""
-        
-        # Load reagent's stock solution concentration
-        stock_conc = pd.read_csv('stocks.csv', header=0)
-        Mg_stock_conc = stock_conc['Mg-glutamate (mM)'].iloc[0]
-        K_stock_conc = stock_conc['K-glutamate (mM)'].iloc[0]
-        P_stock_conc = stock_conc['PEG-8000 (%)'].iloc[0]
-
-        # Load reagent's final concentration
-        Mg_final_conc = sorted_factors_to_lst(factors,'Mg-glutamate')
-        K_final_conc = sorted_factors_to_lst(factors,'K-glutamate')
-        P_final_conc = sorted_factors_to_lst(factors,'PEG-8000')
-
-        # Prepare dilutions
-        for i in range(3):
-            row = pcrtubes_cool.rows()[i]
-            if i == 0:    # Mg-glutamate
-                (Mg_glut_vol_lst, MQ_vol_lst) = calc_volume("Mg-glutamate",Mg_final_conc,Mg_stock_conc,30,20) # final volume is 30 muL
-                if any(vol > 20 for vol in MQ_vol_lst):
-                    for j in range(len(MQ_vol_lst)):
-                        if MQ_vol_lst[j] <= 20:
-                            p20.transfer(MQ_vol_lst[j], MQ, row[j])
-                        else:
-                            p300.transfer(MQ_vol_lst[j], MQ, row[j])
-                else:
-                    p20.transfer(MQ_vol_lst, MQ, row[:len(Mg_final_conc)])
-                if any(vol > 20 for vol in Mg_glut_vol_lst):
-                    for j in range(len(Mg_glut_vol_lst)):
-                        if Mg_glut_vol_lst[j] <= 20:
-                            p20.transfer(Mg_glut_vol_lst[j], Mg_glut, row[j], touch_tip=True, mix_after=(5,15))
-                        else:
-                            p300.transfer(Mg_glut_vol_lst[j], Mg_glut, row[j], touch_tip=True, mix_after=(5,15))
-                else:
-                    p20.transfer(Mg_glut_vol_lst, Mg_glut, row[:len(Mg_final_conc)], touch_tip=True, mix_after=(5,15))
-
-
-            elif i == 1:  # K-glutamate
-                (K_glut_vol_lst, MQ_vol_lst) = calc_volume("K-glutamate",K_final_conc,K_stock_conc,30,13) # final volume is 30 muL
-                if any(vol > 20 for vol in MQ_vol_lst):
-                    for j in range(len(MQ_vol_lst)):
-                        if MQ_vol_lst[j] <= 20:
-                            p20.transfer(MQ_vol_lst[j], MQ, row[j])
-                        else:
-                            p300.transfer(MQ_vol_lst[j], MQ, row[j])
-                else:
-                    p20.transfer(MQ_vol_lst, MQ, row[:len(K_final_conc)])
-                if any(vol > 20 for vol in K_glut_vol_lst):
-                    for j in range(len(K_glut_vol_lst)):
-                        if K_glut_vol_lst[j] <= 20:
-                            p20.transfer(K_glut_vol_lst[j], K_glut, row[j], touch_tip=True, mix_after=(5,15))
-                        else:
-                            p300.transfer(K_glut_vol_lst[j], K_glut, row[j], touch_tip=True, mix_after=(5,15))
-                else:
-                    p20.transfer(K_glut_vol_lst, K_glut, row[:len(K_final_conc)], touch_tip=True, mix_after=(5,15))
-            
-            elif i == 2:  # PEG-8000
-                (PEG8000_vol_lst, MQ_vol_lst) = calc_volume("PEG-8000",P_final_conc,P_stock_conc,30,6.66) # final volume is 30 muL
-                if any(vol > 20 for vol in MQ_vol_lst):
-                    for j in range(len(MQ_vol_lst)):
-                        if MQ_vol_lst[j] <= 20:
-                            p20.transfer(MQ_vol_lst[j], MQ, row[j])
-                        else:
-                            p300.transfer(MQ_vol_lst[j], MQ, row[j])
-                else:
-                    p20.transfer(MQ_vol_lst, MQ, row[:len(P_final_conc)])
-                pipette_vicious(1)  # ON
-                if any(vol > 20 for vol in PEG8000_vol_lst):
-                    for j in range(len(PEG8000_vol_lst)):
-                        if PEG8000_vol_lst[j] <= 20:
-                            p20.transfer(PEG8000_vol_lst[j], PEG8000, row[j], touch_tip=True, mix_after=(5,15))
-                        else:
-                            p300.transfer(PEG8000_vol_lst[j], PEG8000, row[j], touch_tip=True, mix_after=(5,15))
-                else:
-                    p20.transfer(PEG8000_vol_lst, PEG8000, row[:len(P_final_conc)], touch_tip=True, mix_after=(5,15))
-                pipette_vicious(0)  # OFF
-
-    def cfe_mastermix_prep():
+        # Load reagent's stock solution concentration, e.g. 'Mg-glutamate (mM)'
+        stock_conc = read_columns('stocks.csv')
+        stock = []
+        for name in factor_names:
+            units = [column for column in stock_conc if column.startswith(name + ' (')]
+            if not units:
+                raise ValueError("Error: No stock concentration of {} in stocks.csv.".format(name))
+            if len(levels[name]) > 7:
+                raise ValueError("Error: {} has {} levels, the PCR strips hold 7 dilutions per factor.".format(name, len(levels[name])))
+            stock.append(stock_conc[units[0]][0])
+
+        # One row per factor, its levels and in the last column the
+        # reference level of the control if the design has no such level
+        ncols = max(len(levels[name]) for name in factor_names) + 1
+        conc = np.full((len(factor_names), ncols), np.nan)
+        final_vol = np.zeros_like(conc)
+        for i, name in enumerate(factor_names):
+            conc[i, :len(levels[name])] = levels[name]
+            final_vol[i] = dilution_vol[name]
+
+            # Volume loaded to the plate and the control
+            counts = design[name].value_counts()
+            for j, level in enumerate(levels[name]):
+                need = (counts[level] + (reference.get(name) == level)) * load_vol[name] + dead_vol
+                final_vol[i, j] = max(final_vol[i, j], ceil(need))
+            if final_vol[i].max() > dilution_wells[name][0].max_volume:
+                raise ValueError("Error: A {} dilution needs {:.0f} muL, more than a tube holds.".format(name, final_vol[i].max()))
+            if name in reference and reference[name] not in levels[name]:
+                conc[i, -1] = reference[name]
+                final_vol[i, -1] = control_vol
+        stock_vol, mq_vol, source_fold, violations = solve_dilutions(factor_names, conc, stock, final_vol, [dil_factor[name] for name in factor_names])
+        if violations:
+            raise ValueError("Error: {} of the dilution volumes cannot be pipetted:\n{}".format(len(violations), "\n".join(violations)))
+        int_stock_vol, int_mq_vol = intermediate_volumes(stock_vol, source_fold, dead_vol)
+
+        # A stock the PCR tube cannot hold goes in a 2 mL tube of row A of
+        # the Eppendorf block instead
+        for i, name in enumerate(factor_names):
+            needed = np.where(source_fold[i] == 1, stock_vol[i], 0).sum() + int_stock_vol[i] + dead_vol
+            if needed > stocks[name].max_volume:
+                stocks[name] = eppendorftubes_cool.rows()[0][i]
+                plan.comment("{}: the stock needs {:.0f} muL, load it into {}".format(name, needed, stocks[name]))
+
+        ops = []
+        for i, name in enumerate(factor_names):
+            tubes = {j: well for j, well in enumerate(dilution_wells[name][:len(levels[name])])}
+            if not np.isnan(conc[i, -1]):
+                tubes[ncols-1] = control_dilutions[name] = spare_tube(i, name)
+            fold = source_fold[i].max()
+            source = {1: stocks[name]}
+            if fold > 1:
+                source[fold] = spare_tube(i, name)
+                if int_stock_vol[i] + int_mq_vol[i] > source[fold].max_volume:
+                    raise ValueError("Error: The {:g}x intermediate dilution of {} needs {:.0f} muL, more than a tube holds. Lower the {} stock concentration.".format(fold, name, int_stock_vol[i] + int_mq_vol[i], name))
+                plan.comment("{}: {:g}x intermediate dilution of the stock in {}".format(name, fold, source[fold]))
+                ops += [(MQ, source[fold], int_mq_vol[i], 'water'), (stocks[name], source[fold], int_stock_vol[i], stock_class[name])]
+            ops += [(MQ, well, mq_vol[i, j], 'water') for j, well in tubes.items()]
+            ops += [(source[source_fold[i, j]], well, stock_vol[i, j], stock_class[name]) for j, well in tubes.items()]
+        router.route(ops)
+
+    def mastermix_volume(nwells):
+        """muL of mastermix for nwells, 10 % extra and at least enough for
+        the disposal volume of the distribute and the dead volume."""
+        return max(mm_vol * (nwells * 1.1), mm_vol * nwells + p300.pipette.min_volume + dead_vol)
+
+    def cfe_mastermix_prep(nwells):
         """Prepare mastermix excl. factors to optimize.
-        Mastermix consits of BufferW and lysate"""
+        Mastermix consits of BufferW and lysate, and MilliQ when the
+        factors leave room in the reaction"""
          
-        lysate_vol = 4 * (nsamples * 1.1)  #uL
-        bufferW_vol = 3 * (nsamples * 1.1)  #uL
+        lysate_vol = mastermix_volume(nwells) * 4 * scale / mm_vol  #uL
+        bufferW_vol = mastermix_volume(nwells) * 3 * scale / mm_vol  #uL
+        if water_vol:
+            p300.transfer(mastermix_volume(nwells) * water_vol / mm_vol, MQ, MM, blow_out=True, blowout_location='source well')
         p300.transfer(lysate_vol, Lysate, MM,  touch_tip=True, blow_out=True, blowout_location='source well')
         p300.transfer(bufferW_vol, BufferW, MM, blow_out=True, blowout_location='source well')
 
-    def mix_mastermix():
+    def mix_mastermix(nwells):
+        """Mix the mastermix of cfe_mastermix_prep(nwells) from the bottom
+        of the tube, drawing at most half of it, dispensing just above the
+        liquid."""
+        mix_vol = min(300, mastermix_volume(nwells) / 2)
         p300.pick_up_tip()
         for i in range(5):
-            p300.aspirate(300, MM.bottom(1))
-            p300.dispense(300, MM.top(-2))
+            p300.aspirate(mix_vol, MM.bottom(1))
+            p300.dispense(mix_vol, MM)
         p300.drop_tip()    
     
-    def load_combinations(factors):
-        """Makes a full factorial experimental design for the 3 factors
-        Mg-glutamate, K-glutamate and PEG-8000. This is used to load
-        all possible combinations. All wells with the same condition 
-        for a factor is loaded simultanously to the 384-well plate. 
-        Input is the csv file with factors."""
-
-        # Build full factorial design and sort randomly
-        ff = build.full_fact(factors).sample(frac=1)
-        ff.to_csv('DOE.csv')
-        ff_indexed = ff.index
-        Mg_final_conc = sorted_factors_to_lst(factors,'Mg-glutamate')
-        K_final_conc = sorted_factors_to_lst(factors,'K-glutamate')
-        P_final_conc = sorted_factors_to_lst(factors,'PEG-8000')
-
-        # Add Mg-glutamate combinations
-        for i in range(len(Mg_final_conc)):
-            conc_i = ff["Mg-glutamate"]==Mg_final_conc[i]
-            conc_i_wells = []
-            [conc_i_wells.append(j) for j in range(len(conc_i)) if conc_i.tolist()[j] ]
-            dil_well = "A{}".format(i+1)
-            p20.distribute(0.5, pcrtubes_cool.wells_by_name()[dil_well], [plate.wells()[well] for well in conc_i_wells], touch_tip=True, blow_out=True, blowout_location='source well')
-
-        # Add K-glutamate combinations
-        for i in range(len(K_final_conc)):
-            conc_i = ff["K-glutamate"]==K_final_conc[i]
-            conc_i_wells = []
-            [conc_i_wells.append(j) for j in range(len(conc_i)) if conc_i.tolist()[j] ]
-            dil_well = "B{}".format(i+1)
-            p20.distribute(0.75, pcrtubes_cool.wells_by_name()[dil_well], [plate.wells()[well] for well in conc_i_wells], touch_tip=True, blow_out=True, blowout_location='source well')
-        
-        # Add PEG-8000 combinations
-        for i in range(len(P_final_conc)):
-            conc_i = ff["PEG-8000"]==P_final_conc[i]
-            conc_i_wells = []
-            [conc_i_wells.append(j) for j in range(len(conc_i)) if conc_i.tolist()[j] ]
-            dil_well = "C{}".format(i+1)
-            p20.distribute(1.5, pcrtubes_cool.wells_by_name()[dil_well], [plate.wells()[well] for well in conc_i_wells], touch_tip=True, blow_out=True, blowout_location='source well')            
+    def build_design(factors):
+        """Makes the experimental design of design_type for the factors,
+        e.g. Mg-glutamate, K-glutamate and PEG-8000, sorted randomly over
+        the 384-well plate. Returns the design with its plate wells and the
+        well of the control."""
+
+        # Build the design and sort randomly
+        ff = make_design(factors, design_type, lhs_samples, seed).sample(frac=1, random_state=seed)
+
+        # Conditions, one well with mastermix and DNA only, and the control
+        if len(ff) + 2 > len(plate.wells()):
+            raise ValueError("Error: The {} design has {} conditions, the plate holds {}.".format(design_type, len(ff), len(plate.wells()) - 2))
+        ff.insert(0, 'Well', range(len(ff)))
+        control_well = len(ff) + 1
+        levels.update((name, sorted(ff[name].unique())) for name in factor_names)
+        return ff, control_well
+
+    def export_design(design, dna_start):
+        """Export the design with the plate well and estimated DNA start
+        of every condition to DOE.csv."""
+        doe = design.copy()
+        doe['Well'] = [well_name(well) for well in design['Well']]
+        doe['DNA start (s)'] = [round(dna_start[well], 1) for well in design['Well']]
+        doe.to_csv('DOE.csv')
+
+    def load_combinations(index):
+        """Load all combinations of the design. All wells with the same
+        condition for a factor is loaded simultanously to the 384-well plate.
+        Input is the level-to-well index of the design."""
+
+        for name in factor_names:
+            for level in design_levels(index,name):
+                p20.distribute(load_vol[name], dilution_well(name, level), plan_route(index[(name,level)], "{} {}".format(name,level)), touch_tip=True, blow_out=True, blowout_location='source well')
+
+    def load_DNA(wells):
+        """Add the DNA to start the expression to the plate wells, in route
+        order. Uses the most careful DNA mode that keeps the start-time skew
+        within dna_skew_limit and returns the estimated DNA start in s of
+        every plate position, from the first well."""
+        flow_rate = liquid_classes['water']['flow_rate'][20][0]
+        mix = (3, 15)
+
+        def estimate(mode):
+            starts = distribute_times(DNA.top().point, [well.top().point for well in wells], dna_vol, 20, flow_rate, disposal=1,
+                                      touch_tip=mode['touch_tip'], mix=None if mode['mix_once'] else mix, blow_out=True)
+            return {plate.wells().index(well): t for well, t in zip(wells, starts)}
+
+        mode, times = schedule(estimate, dna_skew_limit)
+        plan.comment("DNA: {}, estimated start-time skew {:.0f} s over {} wells".format(mode['name'], skew(times), len(times)))
+        if mode['mix_once']:
+            p20.pick_up_tip()
+            p20.mix(mix[0], mix[1], DNA)
+            p20.distribute(dna_vol, DNA, wells, touch_tip=mode['touch_tip'], blow_out=True, blowout_location='source well', new_tip='never')
+            p20.drop_tip()
+        else:
+            p20.distribute(dna_vol, DNA, wells, touch_tip=mode['touch_tip'], mix_before=mix, blow_out=True, blowout_location='source well')
+        return times
+
+
+    def compile_plan():
+        """Plan the whole run from the input files, from the dilutions to
+        the DNA, and export the design to DOE.csv."""
+
+        # Build the design and dilute its factor levels
+        factors = read_columns('factors.csv')
+        design, control_well = build_design(factors)
+        nsamples = len(design) + 1
+        plan.comment("Design: {}, {} conditions of {} factors".format(design_type, len(design), len(factor_names)))
+        plan.phase("factors_dilution")
+        factors_dilution(design)
+
+        index = index_design(design, factor_names)
+
+        # Prepare and load buffer mix excl. factors for optimization
+        plan.phase("cfe_mastermix_prep")
+        cfe_mastermix_prep(nsamples)
+        plan.phase("mix_mastermix")
+        mix_mastermix(nsamples)
+        plan.phase("load_mastermix")
+        p300.distribute(mm_vol, MM, plan_route(range(nsamples+1), "mastermix"), touch_tip=True, blow_out=True, blowout_location='source well')
+
+        # Load control wo/ DNA and reference concentration for all factors
+        plan.phase("load_control")
+        load_control(plate.wells()[control_well])
+
+        # Load combinations of factors
+        plan.phase("load_combinations")
+        load_combinations(index)
+
+        # Add DNA to initiate cell-free expression
+        # change pipette tip?
+        plan.phase("load_DNA")
+        wells = plan_route(range(nsamples), "DNA")
+        dna_start = load_DNA(wells)
+
+        # Export the design with the estimated DNA start of every condition
+        export_design(design, dna_start)
+
+        plan.share_tips()
+
+        # Follow the liquid in every tube, fails here if one runs dry,
+        # and report what to load into the tubes filled by hand
+        reagents = {'MQ': MQ, 'DNA': DNA, 'BufferW': BufferW, 'Lysate': Lysate}
+        reagents.update(("{} stock".format(name), stocks[name]) for name in factor_names)
+        unknown = set(start_volumes) - set(reagents) - set(factor_names)
+        if unknown:
+            raise ValueError("Error: Unknown reagents {} in start_volumes.".format(", ".join(sorted(unknown))))
+        ledger = Ledger({stocks[name] if name in stocks else reagents[name]: volume for name, volume in start_volumes.items()})
+        plan.track_volumes(ledger)
+        load = {name: ledger.drawn[well] + dead_vol for name, well in reagents.items() if ledger.drawn.get(well, 0) > 0}
+        load.update((name, volume) for name, volume in start_volumes.items() if name in reagents)
+        load.update(("{} stock".format(name), volume) for name, volume in start_volumes.items() if name in stocks)
+        over = ["{} needs {:.0f} muL, its tube {} holds {:.0f} muL".format(name, volume, reagents[name], reagents[name].max_volume)
+                for name, volume in load.items() if volume > reagents[name].max_volume]
+        if over:
+            raise ValueError("Error: {} source tubes are too small:\n{}".format(len(over), "\n".join(over)))
+        load = ["{} {:.0f} muL".format(name, volume) for name, volume in load.items() if name not in start_volumes and name[:-len(" stock")] not in start_volumes]
+        plan.steps.insert(0, (None, 'comment', ("Load at least: " + ", ".join(load),), {}))
 
 
     ## Protocol workflow
-    
-    # Dilute factors based on data from csv file
-    factors = pd.read_csv('factors.csv', header=0)
-    factors_dilution(factors)
-    
-    
-    # Prepare and load buffer mix excl. factors for optimization
-    cfe_mastermix_prep()
-    mix_mastermix()
-    p300.distribute(7, MM, plate.wells()[:nsamples+1], touch_tip=True, blow_out=True, blowout_location='source well')
-
-    # Load control wo/ DNA and reference concentration for all factors
-    load_control(factors)
-
-    # Load combinations of factors
-    load_combinations(factors)
-
-    # Add DNA to initiate cell-free expression
-    # change pipette tip?
-    p20.distribute(0.5, DNA, plate.wells()[:nsamples], touch_tip=True, mix_before=(3,15), blow_out=True, blowout_location='source well')
 
-    temp_module_pcrtubes.deactivate()
-    temp_module_eppendorftubes.deactivate()
+    # Plan the run, or load the plan compiled before from the same inputs
+    settings = {'route': route, 'dna_skew_limit': dna_skew_limit, 'seed': seed,
+                'design_type': design_type, 'lhs_samples': lhs_samples, 'start_volumes': start_volumes}
+    cache = os.path.join('plan_cache', plan_key(['factors.csv', 'stocks.csv'], settings, globals()) + '.json')
+    if seed is not None and os.path.exists(cache):
+        with open('DOE.csv', 'w') as f:
+            f.write(plan.load(cache))
+        protocol.comment("Plan: loaded {}".format(cache))
+    else:
+        compile_plan()
+        if seed is not None:
+            with open('DOE.csv') as f:
+                plan.save(cache, f.read())
+
+    # Load the tips the plan needs before anything moves, then cool and run it
+    plan.load_tip_racks()
+    cold.start()
+    plan.execute(timing, cold)
+
+    timing.phase("deactivate")
+    cold.deactivate()
+    timing.close()
     
@@ -0,0 +1,83 @@
+"""Serial dilution series of the titration protocol.
+
+A DilutionSeries is one reagent diluted from its stock tube down a list of
+tubes, fold times per step. The series gives both the liquid handling
+operations the robot runs and the concentrations they make, so what the run
+reports is what the robot does. parallel_series finds the series an
+8-channel can dilute side by side: the same fold and volume, one per row of
+the same PCR strip columns."""
+
+
+class DilutionSeries:
+    """Serial dilution of a reagent with its stock in tubes[0] and a
+    dilution fold times lower in every next tube, volume muL in each."""
+
+    def __init__(self, reagent, stock, fold, tubes, volume=10):
+        self.reagent = reagent
+        self.stock = stock
+        self.fold = fold
+        self.tubes = tubes
+        self.volume = volume
+
+    @property
+    def carry(self):
+        """muL carried from a tube to the next."""
+        return self.volume / self.fold
+
+    @property
+    def water(self):
+        """muL of MilliQ in every dilution tube."""
+        return self.volume - self.carry
+
+    def concentrations(self):
+        """Concentration in every tube, the stock first."""
+        return [self.stock / self.fold**i for i in range(len(self.tubes))]
+
+    def operations(self, MQ, first=0, last=None):
+        """Router operations of the steps from tube first to tube last:
+        the MilliQ of their dilutions, then the chain of carries."""
+        last = len(self.tubes) - 1 if last is None else last
+        tubes = self.tubes[first:last + 1]
+        return ([(MQ, tube, self.water, 'water') for tube in tubes[1:]]
+                + [(a, b, self.carry, 'dilution') for a, b in zip(tubes, tubes[1:])])
+
+
+def strip_position(well):
+    """(column, row) index of a well in its labware."""
+    for c, column in enumerate(well.parent.columns()):
+        if well in column:
+            return c, column.index(well)
+
+
+def parallel_series(series, channels=8):
+    """Split the series into groups an 8-channel dilutes side by side and
+    series left to a single-channel. The dilution tubes of a series in a
+    group lie along one row, in the same columns of a labware with 8 rows
+    as the other series of the group, which share its fold and volume; no
+    other series has a tube in those columns. Every group is (columns,
+    series), the columns in dilution order; their empty rows get MilliQ."""
+    keys = {}
+    for s in series:
+        positions = [strip_position(tube) for tube in s.tubes[1:]]
+        columns = [c for c, r in positions]
+        if (len(positions) < 2 or len(s.tubes[1].parent.columns()[0]) != channels
+                or len(set(r for c, r in positions)) != 1 or len(set(columns)) != len(columns)
+                or any(tube.parent != s.tubes[1].parent for tube in s.tubes[1:])):
+            keys[id(s)] = None
+        else:
+            keys[id(s)] = (s.tubes[1].parent, tuple(columns), s.fold, s.volume)
+
+    groups = {}
+    for s in series:
+        if keys[id(s)] is not None:
+            groups.setdefault(keys[id(s)], []).append(s)
+
+    # A group owns its columns, other series there would be diluted too
+    parallel = []
+    for key, members in groups.items():
+        labware, columns = key[:2]
+        others = [tube for s in series if s not in members for tube in s.tubes]
+        if len(members) > 1 and not any(strip_position(tube)[0] in columns for tube in others if tube.parent == labware):
+            parallel.append(([labware.columns()[c] for c in columns], members))
+    grouped = [s for columns, members in parallel for s in members]
+    return parallel, [s for s in series if s not in grouped]
@@ -0,0 +1,114 @@
+"""Liquid volumes of the wells of a planned run.
+
+The Ledger follows every aspirate and dispense of a plan. It holds the
+volume of every well that is filled during the run or whose start volume is
+given, works out the liquid height from the well's shape, and fails at plan
+time when the plan draws a well dry. Wells the user fills by hand with no
+given start volume are followed by the volume drawn from them, so the plan
+can report what to load.
+
+The height takes the well as a straight column of its top cross-section.
+Tubes narrow towards the bottom, so the liquid stands at least that high and
+an aspiration below the computed meniscus stays in the liquid."""
+
+from math import pi
+
+from opentrons.protocol_api import Well
+from opentrons.types import Location
+
+submerge = 2      # mm below the meniscus to aspirate
+clearance = 1     # mm above the meniscus to dispense
+min_height = 1    # mm above the bottom, the default of the API
+
+
+def liquid_height(well, volume):
+    """Height in mm of volume muL of liquid in the well."""
+    if well.diameter:
+        area = pi * (well.diameter / 2)**2
+    elif well.length and well.width:
+        area = well.length * well.width
+    else:
+        area = well.max_volume / well.depth
+    return min(well.depth, max(volume, 0) / area)
+
+
+def channel_wells(well, channels):
+    """Wells under the channels of a pipette at a well. The channels are
+    9 mm apart, so they cover every row of a 96 column, every second row
+    of a 384 column and share the one well of a reservoir column."""
+    if channels == 1:
+        return [well]
+    column = next(column for column in well.parent.columns() if well in column)
+    if len(column) < channels:
+        return [well] * channels
+    step = len(column) // channels
+    start = column.index(well)
+    return column[start:start + channels*step:step]
+
+
+def as_well(target):
+    return target.labware.as_well() if isinstance(target, Location) else target
+
+
+def as_list(value, n):
+    return list(value) if isinstance(value, (list, tuple)) else [value] * n
+
+
+class Ledger:
+    """Volumes of the wells of a run in muL. start holds the volumes the
+    user loads before the run."""
+
+    def __init__(self, start=None):
+        self.volumes = dict(start or {})
+        self.drawn = {}
+
+    def aspirate(self, well, volume):
+        if well in self.volumes:
+            if self.volumes[well] - volume < -1e-6:
+                raise ValueError("Error: {} runs dry, the plan draws {:.1f} muL more than it holds.".format(well, volume - self.volumes[well]))
+            self.volumes[well] -= volume
+        else:
+            self.drawn[well] = self.drawn.get(well, 0) + volume
+
+    def dispense(self, well, volume):
+        if well in self.drawn:
+            self.drawn[well] -= volume
+        else:
+            self.volumes[well] = self.volumes.get(well, 0) + volume
+
+    def aspirate_location(self, well):
+        """Just below the meniscus, None for a well of unknown volume."""
+        if well not in self.volumes:
+            return None
+        return well.bottom(max(min_height, liquid_height(well, self.volumes[well]) - submerge))
+
+    def dispense_location(self, well):
+        """Just above the meniscus, None for a well of unknown volume."""
+        if well not in self.volumes:
+            return None
+        return well.bottom(max(min_height, liquid_height(well, self.volumes[well]) + clearance))
+
+    def transfer(self, channels, volumes, sources, dests):
+        """Follow a transfer or distribute of the volumes from the sources
+        to the destinations, each a single value or a list. Returns the
+        sources with every plain well of known volume replaced by the
+        location below its meniscus after the aspiration, which for a
+        single source is after the whole call."""
+        n = max(len(as_list(x, 1)) for x in (volumes, sources, dests))
+        volumes, source_list, dest_list = as_list(volumes, n), as_list(sources, n), as_list(dests, n)
+        located = []
+        for volume, source, dest in zip(volumes, source_list, dest_list):
+            for well in channel_wells(as_well(source), channels):
+                self.aspirate(well, volume)
+            for well in channel_wells(as_well(dest), channels):
+                self.dispense(well, volume)
+            located.append(self.locate(source))
+        if isinstance(sources, (list, tuple)):
+            return located
+        return self.locate(sources)
+
+    def locate(self, target):
+        """Location below the meniscus for a plain well, else the target."""
+        if isinstance(target, Well):
+            return self.aspirate_location(target) or target
+        return target
@@ -0,0 +1,112 @@
+"""Routing of liquid handling operations to the pipettes.
+
+An operation is a (source, destination, volume, liquid class) tuple. The
+Router gives every operation to the smallest pipette that holds its volume,
+groups the operations by pipette and liquid class and runs every group with
+as few transfer and distribute calls as possible, setting the flow rates of
+the pipette once per group.
+
+A liquid class is a dict with the 'flow_rate' (aspirate, dispense) of every
+pipette by its max volume, None to leave the pipette as it is, and the
+'options' passed on to transfer or distribute, e.g.
+
+    {'flow_rate': {20: (2, 2), 300: (10, 10)}, 'options': {'touch_tip': True}}
+"""
+
+
+def set_flow_rate(pipette, aspirate, dispense):
+    """Set the flow rates of a loaded or planned pipette."""
+    if hasattr(pipette, 'set_flow_rate'):
+        pipette.set_flow_rate(aspirate, dispense)
+    else:
+        pipette.flow_rate.aspirate, pipette.flow_rate.dispense = aspirate, dispense
+
+
+class Router:
+    """Runs liquid handling operations grouped by pipette and liquid class.
+
+    pipettes maps the max volume of every pipette to the pipette. Operations
+    into or out of the same well keep their order; a group is split where it
+    would have to run before an operation of another group it depends on.
+    Groups of a liquid class with mix options run as transfers with one tip
+    per source, where a chain of operations from a well filled earlier in the
+    chain (a serial dilution) keeps its tip. Other groups distribute the
+    volumes of every source with one multi-dispense call."""
+
+    def __init__(self, pipettes, liquid_classes, default):
+        self.pipettes = sorted(pipettes.items())
+        self.liquid_classes = liquid_classes
+        self.default = default
+        self.current = {max_volume: default for max_volume, pipette in self.pipettes}
+
+    def pipette_for(self, volume):
+        """Smallest pipette holding the volume, else the largest one."""
+        for max_volume, pipette in self.pipettes:
+            if volume <= max_volume:
+                return max_volume
+        return self.pipettes[-1][0]
+
+    def use_class(self, max_volume, name):
+        """Set the flow rates of a pipette for a liquid class."""
+        if self.current[max_volume] == name:
+            return
+        flow_rate = self.liquid_classes[name]['flow_rate']
+        if flow_rate is not None and flow_rate.get(max_volume) is not None:
+            set_flow_rate(dict(self.pipettes)[max_volume], *flow_rate[max_volume])
+        self.current[max_volume] = name
+
+    def groups(self, operations):
+        """Operations in the order they run, as a list of (pipette max
+        volume, liquid class, operations) groups."""
+        levels = []
+        for i, (source, dest, volume, name) in enumerate(operations):
+            key = (self.pipette_for(volume), name)
+            mixing = 'mix_after' in self.liquid_classes[name]['options']
+            level = 0
+            for j in range(i):
+                p_source, p_dest, p_volume, p_name = operations[j]
+                if p_dest not in (source, dest) and p_source != dest:
+                    continue
+                same_group = (self.pipette_for(p_volume), p_name) == key and (mixing or p_source == source)
+                level = max(level, levels[j] + (0 if same_group else 1))
+            levels.append(level)
+
+        groups = {}
+        for level, operation in zip(levels, operations):
+            key = (level, self.pipette_for(operation[2]), operation[3])
+            groups.setdefault(key, []).append(operation)
+        return [(max_volume, name, group) for (level, max_volume, name), group
+                in sorted(groups.items(), key=lambda item: item[0][0])]
+
+    def route(self, operations):
+        """Run the operations, zero volumes are skipped. The pipettes are
+        set back to the default liquid class at the end."""
+        operations = [operation for operation in operations if operation[2] > 0]
+        for max_volume, name, group in self.groups(operations):
+            pipette = dict(self.pipettes)[max_volume]
+            options = self.liquid_classes[name]['options']
+            self.use_class(max_volume, name)
+            if 'mix_after' in options:
+                # One transfer per source, a chain keeps its tip
+                runs = []
+                for source, dest, volume, _ in group:
+                    if runs and (source is runs[-1][0][0] or source in [op[1] for op in runs[-1]]):
+                        runs[-1].append((source, dest, volume))
+                    else:
+                        runs.append([(source, dest, volume)])
+                for run in runs:
+                    sources = [op[0] for op in run]
+                    source = sources[0] if all(s is sources[0] for s in sources) else sources
+                    pipette.transfer([op[2] for op in run], source, [op[1] for op in run], **options)
+            else:
+                # One multi-dispense per source
+                by_source = {}
+                for source, dest, volume, _ in group:
+                    by_source.setdefault(source, []).append((dest, volume))
+                for source, targets in by_source.items():
+                    if len(targets) == 1:
+                        pipette.transfer(targets[0][1], source, targets[0][0], **options)
+                    else:
+                        pipette.distribute([volume for dest, volume in targets], source, [dest for dest, volume in targets], **options)
+        for max_volume, pipette in self.pipettes:
+            self.use_class(max_volume, self.default)
@@ -0,0 +1,71 @@
+"""Start-time estimates for the DNA additions of the cell-free expression protocols.
+
+Expression starts when the DNA goes into a well, so the wells of one long
+distribute start minutes apart. distribute_times estimates when every well
+gets its DNA from a rough time model of the OT-2, and schedule picks the
+first way of adding the DNA that keeps the spread of the start times (the
+skew) under a limit."""
+
+# Rough step times of the OT-2 for planning, not calibrated
+gantry_speed = 400      # mm/s
+z_time = 1.0            # s to go down into a well and back up
+touch_tip_time = 2.0    # s
+blow_out_time = 0.5     # s
+
+# Ways to add the DNA, from the most careful to the fastest
+dna_modes = [
+    {'name': 'touch tip, mix every aspirate', 'touch_tip': True, 'mix_once': False},
+    {'name': 'no touch tip, mix every aspirate', 'touch_tip': False, 'mix_once': False},
+    {'name': 'no touch tip, mix once', 'touch_tip': False, 'mix_once': True},
+]
+
+
+def travel_time(a, b):
+    """Time to move between two points and into the well at b."""
+    return ((a.x-b.x)**2 + (a.y-b.y)**2)**0.5 / gantry_speed + z_time
+
+
+def distribute_times(source, dests, volume, max_volume, flow_rate, disposal=0, touch_tip=False, mix=None, blow_out=False):
+    """Estimated time in s from the start of a distribute to the dispense
+    into every destination. source and dests are deck points, mix is the
+    (repetitions, volume) of the mix before every aspirate."""
+    per_aspirate = max(1, int((max_volume - disposal) // volume))
+    t = 0
+    here = source
+    times = []
+    for i, dest in enumerate(dests):
+        if i % per_aspirate == 0:
+            if i and blow_out:
+                t += travel_time(here, source) + blow_out_time
+                here = source
+            t += travel_time(here, source)
+            if mix is not None:
+                t += mix[0] * 2 * mix[1] / flow_rate
+            t += (min(per_aspirate, len(dests) - i) * volume + disposal) / flow_rate
+            if touch_tip:
+                t += touch_tip_time
+            here = source
+        t += travel_time(here, dest) + volume / flow_rate
+        times.append(t)
+        here = dest
+        if touch_tip:
+            t += touch_tip_time
+    return times
+
+
+def skew(times):
+    """Spread of the start times of a {well: time} dict."""
+    return max(times.values()) - min(times.values()) if times else 0
+
+
+def schedule(estimate, limit=None):
+    """First DNA mode whose start times stay within the skew limit in s,
+    the first mode when there is no limit. estimate(mode) gives the start
+    time of every well. Returns the mode and the start times relative to
+    the first well."""
+    for mode in dna_modes:
+        times = estimate(mode)
+        if limit is None or skew(times) <= limit:
+            first = min(times.values()) if times else 0
+            return mode, {well: t - first for well, t in times.items()}
+    raise ValueError("Error: Adding the DNA takes an estimated {:.0f} s, over the start-time skew limit of {:.0f} s. Load fewer wells or raise the limit.".format(skew(times), limit))
@@ -0,0 +1,139 @@
+"""Design-space sweep of the cell-free expression protocols.
+
+Simulates a protocol on many candidate inputs at once, one worker process per
+simulation, to find the factors.csv/stocks.csv sets whose volumes can be
+pipetted and whose tips and run time are acceptable before booking the
+robot. The candidates are every fixture directory with factors.csv and
+stocks.csv given with --fixture, crossed with a grid of stock concentrations
+(columns of stocks.csv) and user inputs:
+
+    python cfe_sweep.py --fixture benchmarks/full_factorial --grid "Mg-glutamate (mM)=250,500,1000" --grid design_type=full,box-behnken --output sweep.csv
+
+The results are one CSV table with a row per candidate: feasibility, the
+volume error of the infeasible ones (feasible is empty when the simulation
+itself failed), conditions, tips, estimated duration
+and the muL used of every reagent well.
+"""
+
+import argparse
+import ast
+import concurrent.futures
+import csv
+import itertools
+import os
+import sys
+import tempfile
+
+from cfe_benchmark import fixtures, here, parse_variant, simulate, user_inputs
+
+
+def parse_grid(texts):
+    """Axes of the grid, a list of (name, values) from name=value,value."""
+    axes = []
+    for text in texts:
+        name, values = text.split('=', 1)
+        axes.append((name.strip(), [parse_variant('x=' + value)['x'] for value in values.split(',')]))
+    return axes
+
+
+def write_stocks(fixture, run_dir, stocks):
+    """Copy the fixture's input files to run_dir with the stock
+    concentrations in stocks replaced."""
+    with open(os.path.join(fixture, 'factors.csv')) as src, open(os.path.join(run_dir, 'factors.csv'), 'w') as dst:
+        dst.write(src.read())
+    with open(os.path.join(fixture, 'stocks.csv'), newline='') as f:
+        header, row = list(csv.reader(f))[:2]
+    for name, value in stocks.items():
+        row[header.index(name)] = str(value)
+    with open(os.path.join(run_dir, 'stocks.csv'), 'w', newline='') as f:
+        csv.writer(f).writerows([header, row])
+
+
+def protocol_error(e):
+    """The ValueError("Error: ...") a protocol raised for inputs it cannot
+    plan, None for any other failure. The simulator wraps it."""
+    original = getattr(e, 'original_exc', e)
+    if isinstance(original, ValueError) and str(original).startswith('Error: '):
+        return original
+    return None
+
+
+def run_candidate(candidate):
+    """Simulate one candidate in a worker. A candidate the protocol rejects
+    with its own error is infeasible; any other failure of the simulation
+    is reported as failed, with feasible left empty."""
+    protocol, fixture, stocks, settings, seed = candidate
+    result = {'protocol': protocol, 'fixture': os.path.basename(fixture), 'feasible': True, 'error': ''}
+    result.update(stocks)
+    result.update((name, ast.literal_eval(value)) for name, value in settings.items())
+    with tempfile.TemporaryDirectory() as run_dir:
+        write_stocks(fixture, run_dir, stocks)
+        try:
+            run = simulate(protocol, run_dir, settings, seed)
+        except Exception as e:
+            error = protocol_error(e)
+            if error is None:
+                result.update(feasible=None, error='Simulation failed: {!r}'.format(e).replace('\n', ' '))
+            else:
+                result.update(feasible=False, error=str(error).strip().replace('\n', ' '))
+            return result
+    result.update((key, run[key]) for key in ('conditions', 'duration', 'tips', 'commands'))
+    result.update(('{} (muL)'.format(well), volume) for well, volume in run['reagents'].items())
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--protocol', default='cfe_buffer_optimization.py', help="protocol file (default: %(default)s)")
+    parser.add_argument('--fixture', action='append', help="directory with factors.csv and stocks.csv (default: all in benchmarks/)")
+    parser.add_argument('--grid', action='append', default=[], help="stocks.csv column or user input and its values, e.g. design_type=full,lhs")
+    parser.add_argument('--seed', type=int, help="seed of the random plate design (default: the protocol's seed input)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="worker processes (default: one per CPU)")
+    parser.add_argument('--output', help="write the table to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    # The protocols import the cfe_* helpers next to them
+    sys.path.insert(0, here)
+    fixture_dirs = args.fixture or sorted(os.path.join(fixtures, name) for name in os.listdir(fixtures))
+    axes = parse_grid(args.grid)
+    inputs = user_inputs(args.protocol)
+
+    candidates = []
+    for fixture in fixture_dirs:
+        with open(os.path.join(fixture, 'stocks.csv'), newline='') as f:
+            stock_columns = next(csv.reader(f))
+        for point in itertools.product(*[values for name, values in axes]):
+            stocks = {}
+            settings = {}
+            for (name, values), value in zip(axes, point):
+                if name in stock_columns:
+                    stocks[name] = value
+                elif name in inputs:
+                    settings[name] = value
+                else:
+                    raise ValueError("Error: {} is neither a column of {} nor a user input of {}.".format(name, os.path.join(fixture, 'stocks.csv'), args.protocol))
+            candidates.append((args.protocol, fixture, stocks, settings, args.seed))
+
+    print("Sweeping {} candidates with {} workers".format(len(candidates), args.jobs), file=sys.stderr)
+    rows = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for i, row in enumerate(pool.map(run_candidate, candidates)):
+            print("{}/{} {} {}".format(i + 1, len(candidates), row['fixture'], 'feasible' if row['feasible'] else row['error']), file=sys.stderr)
+            rows.append(row)
+    failed = sum(row['feasible'] is None for row in rows)
+    if failed:
+        print("{} of {} simulations failed for reasons other than the inputs, check the opentrons install".format(failed, len(rows)), file=sys.stderr)
+
+    columns = []
+    for row in rows:
+        columns += [column for column in row if column not in columns]
+    f = open(args.output, 'w', newline='') if args.output else sys.stdout
+    writer = csv.DictWriter(f, columns)
+    writer.writeheader()
+    writer.writerows(rows)
+    if args.output:
+        f.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Cooling of the temperature modules of the cell-free expression protocols.
+
+set_temperature blocks until a module has reached its target, so cooling two
+modules one after the other keeps the robot idle for both cool-downs.
+ColdBlocks starts every module at once and waits for a module only before
+the first step that touches the labware on it. A protocol that drives its
+pipettes directly wraps them in a ColdPipette, which checks the labware of
+every liquid handling command."""
+
+from opentrons.protocol_api import Well
+from opentrons.types import Location
+
+
+def labware_of(target):
+    """Labware a well, location or list of them belongs to."""
+    if isinstance(target, (list, tuple)):
+        return [labware for t in target for labware in labware_of(t)]
+    if isinstance(target, Location):
+        target = target.labware.object
+    if isinstance(target, Well):
+        return [target.parent]
+    return []
+
+
+class ColdBlocks:
+    """Temperature modules that cool while the protocol carries on.
+
+    mode is "overlap" to start all modules at once and wait at the first
+    step on a cooled labware, "serial" to cool them one after the other
+    before the run, or None to leave them off."""
+
+    def __init__(self, modules, celsius=4, mode="overlap"):
+        if mode not in ("overlap", "serial", None):
+            raise ValueError("Error: Unknown cooling mode {}.".format(mode))
+        self.modules = list(modules) if mode else []
+        self.celsius = celsius
+        self.mode = mode
+        self.waiting = []
+
+    def start(self):
+        """Start cooling, in serial mode wait for each module in turn."""
+        for module in self.modules:
+            if self.mode == "serial":
+                module.set_temperature(self.celsius)
+            else:
+                module.start_set_temperature(self.celsius)
+                self.waiting.append(module)
+
+    def touch(self, *targets):
+        """Wait for the modules holding any of the targets to be cold."""
+        if not self.waiting:
+            return
+        touched = labware_of(list(targets))
+        for module in list(self.waiting):
+            if any(labware is module.labware for labware in touched):
+                module.await_temperature(self.celsius)
+                self.waiting.remove(module)
+
+    def deactivate(self):
+        for module in self.modules:
+            module.deactivate()
+
+
+class ColdPipette:
+    """Pipette that waits for the cold blocks before every liquid handling
+    command on labware they hold. Other attributes are the pipette's."""
+
+    commands = ('aspirate', 'dispense', 'mix', 'blow_out', 'touch_tip', 'transfer', 'distribute', 'consolidate')
+
+    def __init__(self, pipette, cold):
+        self.pipette = pipette
+        self.cold = cold
+
+    def __getattr__(self, name):
+        attr = getattr(self.pipette, name)
+        if name not in self.commands:
+            return attr
+
+        def command(*args, **kwargs):
+            self.cold.touch(*args, *kwargs.values())
+            return attr(*args, **kwargs)
+        return command
@@ -0,0 +1,87 @@
+"""Timing log for the cell-free expression protocols.
+
+TimingLog listens to the commands the protocol context publishes and writes
+one JSON line per pipette command and one summary line per phase of the run,
+so we can see where a run spends its time and check speed-ups against it."""
+
+import json
+import time
+
+
+def position(location):
+    """Deck coordinates of a command's target, None if it has none."""
+    if hasattr(location, 'point'):
+        return location.point
+    if hasattr(location, 'top'):
+        return location.top().point
+    return None
+
+
+class TimingLog:
+    """Structured timing of a protocol run in JSON lines.
+
+    Command lines hold the phase, command name, start (s from the start of
+    the log), duration and nesting depth; a transfer is logged with the
+    aspirations and dispenses it is made of. Phase lines hold the duration,
+    tip pickups, aspirations, dispenses and gantry travel in mm between the
+    targets of the commands. A phase runs until the next one starts or the
+    log is closed."""
+
+    def __init__(self, protocol, path='timing.jsonl'):
+        self.file = open(path, 'w')
+        self.t0 = time.monotonic()
+        self.started = []
+        self.location = None
+        self.summary = None
+        self.unsubscribe = protocol.broker.subscribe('command', self.on_message)
+
+    def now(self):
+        return time.monotonic() - self.t0
+
+    def write(self, line):
+        self.file.write(json.dumps(line) + '\n')
+        self.file.flush()
+
+    def phase(self, name):
+        """End the current phase and start the next."""
+        self.end_phase()
+        self.summary = {'type': 'phase', 'phase': name, 'start': self.now(), 'duration': 0,
+                        'commands': 0, 'tips': 0, 'aspirations': 0, 'dispenses': 0, 'travel': 0.0}
+
+    def end_phase(self):
+        if self.summary is not None:
+            self.summary['duration'] = self.now() - self.summary['start']
+            self.write(self.summary)
+            self.summary = None
+
+    def on_message(self, message):
+        if message['$'] == 'before':
+            self.started.append(self.now())
+            return
+        start = self.started.pop()
+        name = message['name'].split('.')[-1]
+        self.write({'type': 'command', 'phase': self.summary and self.summary['phase'],
+                    'command': name, 'start': start, 'duration': self.now() - start,
+                    'depth': len(self.started), 'text': message['payload'].get('text')})
+        if self.summary is None:
+            return
+
+        self.summary['commands'] += 1
+        if name == 'PICK_UP_TIP':
+            self.summary['tips'] += 1
+        elif name == 'ASPIRATE':
+            self.summary['aspirations'] += 1
+        elif name == 'DISPENSE':
+            self.summary['dispenses'] += 1
+        target = position(message['payload'].get('location'))
+        if target is not None:
+            if self.location is not None:
+                self.summary['travel'] += ((target.x - self.location.x)**2 + (target.y - self.location.y)**2
+                                           + (target.z - self.location.z)**2)**0.5
+            self.location = target
+
+    def close(self):
+        """Write the last phase and stop listening to the protocol."""
+        self.end_phase()
+        self.unsubscribe()
+        self.file.close()
@@ -1,13 +1,22 @@
 from opentrons import protocol_api
+from math import ceil
+import csv
 import sys
 
+from cfe_dilution import DilutionSeries, parallel_series
+from cfe_router import Router
+from cfe_schedule import distribute_times, schedule, skew
+from cfe_temperature import ColdBlocks, ColdPipette
+from cfe_timing import TimingLog
+
 metadata = {
     'apiLevel': '2.8',
     'protocolName': 'Cell Free expression titration curve',
     'description': '''This protocol is for setting up a 
      logaritmic serial dilution of a single reagent for cell free expression. 
-     In total 7 concentrations of the reagnet are tested in technical triplicates
-     including an internal control without DNA.''',
+     By default 7 concentrations of the reagnet are tested in technical triplicates
+     including an internal control without DNA. In batch mode up to 16
+     reagents from a table are titrated in the 16 rows of the plate.''',
     'author': 'Karen Therkelsen (s173684@dtu.dk)',
 }
 
@@ -16,25 +25,46 @@ metadata = {
 # Define row in well-plate to load
 row = "H"
 
-# Define reagent stock concentration
+# Define reagent stock concentration and its dilution per step
 conc = float(6) # mM
+fold = 10
 
-####################################################################################
+# Batch mode: CSV table with a Reagent, Stock (mM) and Fold (dilution per
+# step, default 10) column, one row of the plate per reagent from row A on.
+# None titrates the single reagent above
+batch = None
+
+# Dilutions of the stock in every series and wells per concentration. A
+# plate row holds the stock, the dilutions and the control in replicates
+steps = 6
+replicates = 3
+
+# Serial dilution of a batch: "single" dilutes one reagent at a time with
+# the P20, "multichannel" dilutes reagents of the same fold side by side down
+# the PCR strip columns with an 8-channel P20, which takes the place of the
+# P300. Its plate rows alternate (A, C, ... O, then B, D, ... P), so the
+# 8-channel also loads 8 reagents of the same fold at once
+layout = "single"
 
-# Display titration curve
-conc_lst = []
-for i in range(7):
-    if i == 0:
-        new_conc = float(conc)/2
-        conc_lst.append(str(conc))
-    new_conc = float(new_conc)/2
-    conc_lst.append(str(new_conc))
-print("The following titration row will be made:\n{}\n".format(",".join(conc_lst)))
+# Cooling of the temperature modules to 4 C: "overlap" starts both modules at
+# once and waits only before the first step on a cooled block, "serial" cools
+# them one after the other before the run, None leaves them off
+cooling = "overlap"
 
-nsamples = 8 * 3
+# Limit in s on the spread of the DNA start times over the row, the DNA is
+# added without touch tip when needed; None only reports it
+dna_skew_limit = None
+
+####################################################################################
+
+nsamples = (steps + 2) * replicates
 
 
 def run(protocol):
+
+    # Time every phase and pipette command of the run, see timing.jsonl
+    timing = TimingLog(protocol)
+    timing.phase("setup")
     
     ## Load instrument, modules and labware ##
 
@@ -53,11 +83,43 @@ def run(protocol):
     #------------- #------------- #------------- #
 
 
-    # Pipettes and tips
-    tips20 = protocol.load_labware('opentrons_96_tiprack_20ul', 8)
-    tips300 = protocol.load_labware('opentrons_96_tiprack_300ul', 9)
-    p20 = protocol.load_instrument('p20_single_gen2', mount='right', tip_racks=[tips20])
-    p300 = protocol.load_instrument('p300_single', mount='left', tip_racks=[tips300])
+    # Batch mode
+    #  15mL falcon rack with the mastermix in slot 5,
+    #  extra P20 tips in slots 1, 2, 3 when needed
+    # Multichannel layout
+    #  reservoir with the mastermix and MilliQ in slot 5,
+    #  8-channel P20 tips in slot 9, then 6 and 7
+
+
+    # Titrations to run, one per plate row
+    if batch is None:
+        table = [{'Reagent': 'X', 'Stock (mM)': conc, 'Fold': fold}]
+    else:
+        with open(batch) as f:
+            table = list(csv.DictReader(f))
+        if len(table) > 16:
+            raise ValueError("Error: The batch has {} reagents, the plate has rows for 16.".format(len(table)))
+    if nsamples > 24:
+        raise ValueError("Error: {} concentrations and the control in {} replicates take {} wells, a plate row has 24.".format(steps + 1, replicates, nsamples))
+    if batch is None and steps > 7:
+        raise ValueError("Error: {} dilutions do not fit the first PCR strip column, it holds 7.".format(steps))
+    if batch is not None and ceil(len(table) / 8) * steps > 12:
+        raise ValueError("Error: {} reagents with {} dilutions each do not fit the 12 PCR strip columns.".format(len(table), steps))
+    if layout == "multichannel" and batch is None:
+        raise ValueError("Error: The multichannel layout dilutes the reagents of a batch side by side, set batch.")
+    total_samples = nsamples * len(table)
+
+    # Pipettes and tips, about steps + 3 P20 tips per titration
+    tips20 = [protocol.load_labware('opentrons_96_tiprack_20ul', slot) for slot in [8, 1, 2, 3][:ceil((3 + (steps + 3)*len(table)) / 96)]]
+    p20 = protocol.load_instrument('p20_single_gen2', mount='right', tip_racks=tips20)
+    if layout == "multichannel":
+        # About steps + 4 columns of tips for every group of 8 reagents
+        tips20m = [protocol.load_labware('opentrons_96_tiprack_20ul', slot) for slot in [9, 6, 7][:ceil((1 + ceil(len(table) / 8)*(steps + 4)) / 12)]]
+        p20m = protocol.load_instrument('p20_multi_gen2', mount='left', tip_racks=tips20m)
+        p300 = None
+    else:
+        tips300 = protocol.load_labware('opentrons_96_tiprack_300ul', 9)
+        p300 = protocol.load_instrument('p300_single', mount='left', tip_racks=[tips300])
 
     # 384-well plate
     plate = protocol.load_labware('corning_384_wellplate_112ul_flat', 11)
@@ -68,77 +130,242 @@ def run(protocol):
 
     temp_module_eppendorftubes = protocol.load_module('temperature module gen2', 4)
     eppendorftubes_cool = temp_module_eppendorftubes.load_labware('opentrons_24_aluminumblock_nest_2ml_snapcap')
+
+    # Every pipette command waits for the cold blocks it touches
+    cold = ColdBlocks([temp_module_pcrtubes, temp_module_eppendorftubes], 4, cooling)
+    p20 = ColdPipette(p20, cold)
+    if layout == "multichannel":
+        p20m = ColdPipette(p20m, cold)
+    else:
+        p300 = ColdPipette(p300, cold)
     
 
     ## Define start reagents
 
-    # In PCR module
-    X = pcrtubes_cool.wells()[0]            # 15 uL
-    DNA = pcrtubes_cool.wells()[8]          # 15 uL
-    rNTP = pcrtubes_cool.wells()[9]         # 15 uL
-    Lysate = pcrtubes_cool.wells()[10]      # 110 uL
-    Buffer = pcrtubes_cool.wells()[11]      # 125 uL
+    if batch is None:
+        # In PCR module
+        X = pcrtubes_cool.wells()[0]            # 15 uL
+        DNA = pcrtubes_cool.wells()[8]          # 15 uL
+        rNTP = pcrtubes_cool.wells()[9]         # 15 uL
+        Lysate = pcrtubes_cool.wells()[10]      # 110 uL
+        Buffer = pcrtubes_cool.wells()[11]      # 125 uL
+
+        # In Eppendorf module
+        MQ = eppendorftubes_cool.wells_by_name()["A1"]     # 1 mL
+        MM = eppendorftubes_cool.wells_by_name()["A2"]
+    else:
+        # In Eppendorf module, reagent stocks from B2 on in column order
+        MQ = eppendorftubes_cool.wells_by_name()["A1"]       # 2 mL
+        Lysate = eppendorftubes_cool.wells_by_name()["B1"]   # 1.7 mL
+        Buffer = eppendorftubes_cool.wells_by_name()["C1"]   # 1.9 mL
+        rNTP = eppendorftubes_cool.wells_by_name()["D1"]     # 220 uL
+        DNA = eppendorftubes_cool.wells_by_name()["A2"]      # 200 uL
+
+        # In rack, the mastermix of the whole plate, or in the reservoir
+        # with the MilliQ the 8-channel aspirates
+        if layout == "multichannel":
+            reservoir = protocol.load_labware('nest_12_reservoir_15ml', 5)
+            MM = reservoir.wells_by_name()["A1"]
+            MQ = reservoir.wells_by_name()["A2"]             # 3 mL
+        else:
+            rack = protocol.load_labware('opentrons_15_tuberack_falcon_15ml_conical', 5)
+            MM = rack.wells_by_name()["A1"]
+
+    # Dilution series and plate row of every titration. In batch mode the
+    # dilutions of a reagent go along a row of the PCR strips, 8 reagents
+    # in columns 1-6 and 8 in columns 7-12 with the default 6 steps. The
+    # multichannel layout puts the 8 reagents of a strip row group in every
+    # second plate row, under the channels of the 8-channel
+    titrations = []
+    for i, entry in enumerate(table):
+        step_fold = float(entry.get('Fold') or 10)
+        if not 1 < step_fold <= 20:
+            raise ValueError("Error: Fold {} of {} must be above 1 and at most 20 to transfer 0.5 muL or more.".format(step_fold, entry['Reagent']))
+        if batch is None:
+            tubes = pcrtubes_cool.wells()[:steps + 1]
+            plate_row = row
+        else:
+            tubes = [eppendorftubes_cool.wells()[5+i]] + pcrtubes_cool.rows()[i % 8][(i // 8)*steps:(i // 8)*steps + steps]
+            plate_row = ("ACEGIKMOBDFHJLNP" if layout == "multichannel" else "ABCDEFGHIJKLMNOP")[i]
+        titrations.append({'series': DilutionSeries(entry['Reagent'], float(entry['Stock (mM)']), step_fold, tubes),
+                           'wells': plate.rows_by_name()[plate_row][:nsamples]})
+
+    # Display the titration curves the dilutions below make, 0.5 muL of a
+    # tube in the 10 muL wells
+    for titration in titrations:
+        series = titration['series']
+        protocol.comment("{} titration row, mM in the tubes: {}; in the wells: {}".format(
+            series.reagent, ", ".join("{:g}".format(c) for c in series.concentrations()),
+            ", ".join("{:g}".format(c * 0.5 / 10) for c in series.concentrations())))
+
+    # Series the 8-channel dilutes side by side, a group of 8 fills every
+    # second row of its plate rows and is loaded side by side too
+    if layout == "multichannel":
+        groups, singles = parallel_series([titration['series'] for titration in titrations])
+    else:
+        groups, singles = [], [titration['series'] for titration in titrations]
+    if layout == "multichannel":
+        protocol.comment("Multichannel: {} of {} reagents diluted side by side, {} loaded side by side".format(
+            sum(len(members) for columns, members in groups), len(titrations), 8 * sum(len(members) == 8 for columns, members in groups)))
+    full_groups = [(columns, members) for columns, members in groups if len(members) == 8]
+    loaded_by_8 = [s for columns, members in full_groups for s in members]
+
+    def titration_of(series):
+        return next(titration for titration in titrations if titration['series'] is series)
 
-    # In Eppendorf module
-    MQ = eppendorftubes_cool.wells_by_name()["A1"]     # 1 mL
-    MM = eppendorftubes_cool.wells_by_name()["A2"]
+
+    ## Liquid classes, the pipettes keep their default flow rates
+    liquid_classes = {
+        'water': {'flow_rate': None, 'options': {}},
+        'dilution': {'flow_rate': None, 'options': {'mix_after': (3,5)}},
+        'mastermix': {'flow_rate': None, 'options': {'touch_tip': True}},
+    }
+    router = Router({20: p20} if p300 is None else {20: p20, 300: p300}, liquid_classes, 'water')
 
 
     ## Functions
 
     def serial_dilution():
-        """Prepare logaritmic serial dilution with reagent"""
-        p20.distribute(9, MQ, pcrtubes_cool.wells()[1:7])
+        """Prepare logaritmic serial dilution with reagent, 10 muL in
+        every tube. All MilliQ goes in with one tip, then every reagent is
+        diluted down its tubes. In the multichannel layout the 8-channel
+        adds the MilliQ and dilutes the rows of a strip column group side
+        by side, after the P20 made their first dilutions from the stocks."""
+        for columns, members in groups:
+            p20m.distribute(members[0].water, MQ, [column[0] for column in columns], blow_out=True, blowout_location='source well')
+
+        ops = []
+        for s in singles:
+            ops += s.operations(MQ)
+        for columns, members in groups:
+            ops += [op for s in members for op in s.operations(MQ, 0, 1) if op[3] == 'dilution']
+        router.route(ops)
+
+        for columns, members in groups:
+            p20m.pick_up_tip()
+            for a, b in zip(columns, columns[1:]):
+                p20m.transfer(members[0].carry, a[0], b[0], new_tip='never', **liquid_classes['dilution']['options'])
+            p20m.drop_tip()
+
+    def load_stock(titration):
+        """Load the stock of a titration to its first wells and the
+        control wells."""
+        tubes, wells = titration['series'].tubes, titration['wells']
+        r = replicates
         p20.pick_up_tip()
-        p20.transfer(1, pcrtubes_cool.wells()[:6], pcrtubes_cool.wells()[1:7], mix_after=(3,5), new_tip="never")
+        p20.distribute(0.5, tubes[0], wells[nsamples-r:nsamples], touch_tip=True, new_tip="never")
+        p20.distribute(0.5, tubes[0], wells[:r], touch_tip=True, new_tip="never")
         p20.drop_tip()
 
+    def load_reagent(titration):
+        """Load the dilutions of a titration to its plate row in
+        replicates, and the stock with MilliQ to the control wells."""
+        tubes, wells = titration['series'].tubes, titration['wells']
+        r = replicates
+        load_stock(titration)
+        p20.distribute(0.5, MQ, wells[nsamples-r:nsamples], touch_tip=True)
+        for dil_no in range(1, len(tubes)):
+            p20.distribute(0.5, tubes[dil_no], wells[dil_no*r:(dil_no+1)*r], touch_tip=True)
+
+    def load_reagent_by_8(columns, members):
+        """Load the dilutions of a group of 8 titrations side by side with
+        the 8-channel, from their strip columns to every second plate row.
+        The stocks go in one by one with the P20."""
+        for series in members:
+            load_stock(titration_of(series))
+        wells = titration_of(members[0])['wells']
+        r = replicates
+        p20m.distribute(0.5, MQ, wells[nsamples-r:nsamples], touch_tip=True)
+        for dil_no, column in enumerate(columns, start=1):
+            p20m.distribute(0.5, column[0], wells[dil_no*r:(dil_no+1)*r], touch_tip=True)
+
+    def dna_wells():
+        """Wells that get DNA, row after row in alternating direction."""
+        wells = []
+        for i, titration in enumerate(titrations):
+            row_wells = titration['wells'][:nsamples-replicates]
+            wells += row_wells if i % 2 == 0 else row_wells[::-1]
+        return wells
+
+    def mastermix_volume():
+        """muL of mastermix for all samples, with extra for the dead volume."""
+        extra = 1.2 if batch is None else 1.1    # a plate of lysate and buffer just fits 2 mL tubes
+        return 9 * total_samples * extra
+
     def mix_mastermix():
-        """Ensure homogenous mastermix before loding"""
-        p300.pick_up_tip()
-        for i in range(5):
-            p300.aspirate(100, MM.bottom(1))
-            p300.dispense(100, MM.top(-20))
-        p300.drop_tip()
+        """Ensure homogenous mastermix before loding. The mix volume and
+        cycles grow with the mastermix, so about all of it is drawn once."""
+        mm_vol = mastermix_volume()
+        if layout == "multichannel":
+            # Mix in the reservoir with all 8 channels
+            cycles = max(5, ceil(mm_vol / (8 * 20)))
+            p20m.pick_up_tip()
+            for i in range(cycles):
+                p20m.aspirate(20, MM.bottom(1))
+                p20m.dispense(20, MM.top(-2))
+            p20m.drop_tip()
+        else:
+            mix_vol = min(300, max(100, mm_vol / 4))
+            cycles = max(5, ceil(mm_vol / mix_vol))
+            p300.pick_up_tip()
+            for i in range(cycles):
+                p300.aspirate(mix_vol, MM.bottom(1))
+                p300.dispense(mix_vol, MM.top(-20))
+            p300.drop_tip()
      
     def cfe_mastermix_prep():
         """Prepare CFE master mix excl. reagent"""
-        lysate_vol = 4 * (nsamples * 1.2) #uL
-        buffer_vol = 4.5 * (nsamples * 1.2)  #uL
-        rNTP_vol = 0.5 * (nsamples * 1.2)  #uL
+        lysate_vol = mastermix_volume() * 4 / 9  #uL
+        buffer_vol = mastermix_volume() * 4.5 / 9  #uL
+        rNTP_vol = mastermix_volume() * 0.5 / 9  #uL
+
+        router.route([(Lysate, MM, lysate_vol, 'mastermix'),
+                      (Buffer, MM, buffer_vol, 'mastermix'),
+                      (rNTP, MM, rNTP_vol, 'mastermix')])
+    
 
-        p300.transfer(lysate_vol, Lysate, MM, touch_tip=True)
-        p300.transfer(buffer_vol, Buffer, MM, touch_tip=True)
-        p20.transfer(rNTP_vol, rNTP, MM, touch_tip=True)
+    def estimate_DNA(mode):
+        """Estimated start of the expression in every well, in s from the
+        start of the DNA distribute."""
+        wells = dna_wells()
+        starts = distribute_times(DNA.top().point, [well.top().point for well in wells], 0.5, p20.max_volume, p20.flow_rate.dispense,
+                                  disposal=p20.min_volume, touch_tip=mode['touch_tip'])
+        return dict(zip([well.well_name for well in wells], starts))
     
 
     ## Protocol workflow
     
-    #temp_module_pcrtubes.set_temperature(4)
-    #temp_module_eppendorftubes.set_temperature(4)
+    cold.start()
 
     # Prepare master mix and serial dilution
+    timing.phase("serial_dilution")
     serial_dilution()
+    timing.phase("cfe_mastermix_prep")
     cfe_mastermix_prep()
 
     # Add Add mastermix
+    timing.phase("mix_mastermix")
     mix_mastermix()
-    p20.distribute(9.0, MM, plate.rows_by_name()[row][:nsamples], touch_tip=True, blow_out=True, blowout_location='source well')
+    timing.phase("load_mastermix")
+    for columns, members in full_groups:
+        p20m.distribute(9.0, MM, titration_of(members[0])['wells'], touch_tip=True, blow_out=True, blowout_location='source well')
+    rest = [well for titration in titrations if titration['series'] not in loaded_by_8 for well in titration['wells']]
+    if rest:
+        p20.distribute(9.0, MM, rest, touch_tip=True, blow_out=True, blowout_location='source well')
     
     # Add reagent
-    for i in range(0,nsamples-3,3):
-        dil_no = int((i+1)/3)
-        if dil_no == 0:  # Load to internal control
-            p20.pick_up_tip()
-            p20.distribute(0.5, pcrtubes_cool.wells()[dil_no], plate.rows_by_name()[row][nsamples-3:nsamples], touch_tip=True, new_tip="never")
-            p20.distribute(0.5, pcrtubes_cool.wells()[dil_no], plate.rows_by_name()[row][:i+3], touch_tip=True, new_tip="never")
-            p20.drop_tip()
-            p20.distribute(0.5, MQ, plate.rows_by_name()[row][nsamples-3:nsamples], touch_tip=True)
-        else:
-            p20.distribute(0.5, pcrtubes_cool.wells()[dil_no], plate.rows_by_name()[row][i:i+3], touch_tip=True)
+    timing.phase("load_reagent")
+    for columns, members in full_groups:
+        load_reagent_by_8(columns, members)
+    for titration in titrations:
+        if titration['series'] not in loaded_by_8:
+            load_reagent(titration)
 
     # Add DNA to initate CFE
-    p20.distribute(0.5, DNA, plate.rows_by_name()[row][:nsamples-3], touch_tip=True)
+    timing.phase("load_DNA")
+    mode, dna_start = schedule(estimate_DNA, dna_skew_limit)
+    protocol.comment("DNA: {}, estimated start-time skew {:.0f} s over {} wells".format("touch tip" if mode['touch_tip'] else "no touch tip", skew(dna_start), len(dna_start)))
+    p20.distribute(0.5, DNA, dna_wells(), touch_tip=mode['touch_tip'])
 
-    #temp_module_pcrtubes.deactivate()
-    #temp_module_eppendorftubes.deactivate()
+    cold.deactivate()
+    timing.close()
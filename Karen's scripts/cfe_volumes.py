@@ -0,0 +1,66 @@
+"""Volumes of the factor dilutions of the cell-free expression protocols.
+
+solve_dilutions computes the stock and MilliQ volume of every dilution of
+every factor at once as NumPy array operations and checks the whole plan
+against the pipette limits, so all volumes that cannot be pipetted are
+reported together. A stock volume below the 0.5 muL the P20 can pipette is
+taken from an intermediate dilution of the stock instead, with the smallest
+fold in folds that brings every such volume of the factor into range."""
+
+import numpy as np
+
+min_volume = 0.5                        # muL the P20 can pipette
+folds = np.array([2, 5, 10, 20, 50, 100])   # intermediate dilutions of a stock
+
+
+def solve_dilutions(names, conc, stock, final_vol, dil_factor):
+    """Volumes of the dilutions of every factor.
+
+    conc holds the well concentrations of one factor per row, padded with
+    NaN, stock and dil_factor (tube to well dilution) one value per factor
+    and final_vol the muL of the dilutions of a factor, or of every dilution
+    in the shape of conc. Returns the stock and MilliQ volume of every
+    dilution, the fold of its source (1 for the stock, else the intermediate
+    dilution of the factor) and the list of violations."""
+    conc = np.asarray(conc, dtype=float)
+    stock = np.asarray(stock, dtype=float)[:, None]
+    final_vol = np.asarray(final_vol, dtype=float)
+    final_vol = np.broadcast_to(final_vol[:, None] if final_vol.ndim == 1 else final_vol, conc.shape)
+    dil_factor = np.asarray(dil_factor, dtype=float)[:, None]
+    levels = ~np.isnan(conc)
+
+    vol = np.where(levels, conc * dil_factor * final_vol / stock, 0)
+    low = (vol > 0) & (vol < min_volume)
+
+    # Smallest fold per factor that lifts all its low volumes to min_volume
+    # and keeps them within their dilution volumes
+    low_min = np.where(low, vol, np.inf).min(axis=1)
+    low_room = np.where(low, final_vol / np.where(low, vol, 1), np.inf).min(axis=1)
+    fits = (low_min[:, None] * folds >= min_volume) & (folds <= low_room[:, None])
+    fold = np.where(fits.any(axis=1), folds[fits.argmax(axis=1)], 0)
+    fold = np.where(low.any(axis=1), fold, 1)
+    source_fold = np.where(low, fold[:, None], 1)
+    vol = vol * np.maximum(source_fold, 1)
+
+    # A dilution within 1 muL of the full volume is all stock
+    full = np.ceil(vol) == final_vol
+    stock_vol = np.where(full, final_vol, vol)
+    mq_vol = np.where(levels & ~full, final_vol - vol, 0)
+
+    violations = []
+    for i, j in zip(*np.nonzero(levels & (vol > final_vol))):
+        violations.append("{} {}: stock volume {:.2f} muL exceeds {:g} muL. Raise the {} stock concentration.".format(names[i], conc[i, j], vol[i, j], final_vol[i, j], names[i]))
+    for i in np.nonzero(low.any(axis=1) & (fold == 0))[0]:
+        violations.append("{}: stock volumes down to {:.3f} muL, no intermediate dilution up to {}x brings them to {} muL. Lower the {} stock concentration.".format(names[i], low_min[i], folds[-1], min_volume, names[i]))
+    for i, j in zip(*np.nonzero(levels & ~full & (vol <= final_vol) & (final_vol - vol < min_volume))):
+        violations.append("{} {}: MilliQ volume {:.2f} muL is lower than {} muL. Change the {} stock concentration.".format(names[i], conc[i, j], final_vol[i, j] - vol[i, j], min_volume, names[i]))
+    return stock_vol, mq_vol, source_fold, violations
+
+
+def intermediate_volumes(stock_vol, source_fold, dead_vol):
+    """Stock and MilliQ volume of the intermediate dilution of every factor,
+    enough for its dilutions and the dead volume, 0 when it needs none."""
+    fold = source_fold.max(axis=1)
+    needed = np.where(source_fold > 1, stock_vol, 0).sum(axis=1) + dead_vol
+    total = np.where(fold > 1, np.maximum(needed, min_volume * fold), 0)
+    return total / np.maximum(fold, 1), total - total / np.maximum(fold, 1)
@@ -0,0 +1,52 @@
+"""index_design has to scale with the size of the design, it runs once per
+plan on designs far larger than a plate."""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "Karen's scripts"))
+from cfe_buffer_optimization import index_design
+
+
+factor_names = ['Mg-glutamate', 'K-glutamate', 'PEG-8000']
+
+
+def random_design(nrows, seed=0):
+    """Design of nrows conditions over 7 levels of every factor, one
+    plate well each."""
+    rng = np.random.default_rng(seed)
+    design = pd.DataFrame({name: rng.choice(np.linspace(1, 7, 7), nrows) for name in factor_names})
+    design.insert(0, 'Well', range(nrows))
+    return design
+
+
+def best_time(design, repeats=5):
+    """Fastest of repeats runs of index_design in s."""
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        index_design(design, factor_names)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def test_index_design_groups_every_well():
+    design = random_design(343)
+    index = index_design(design, factor_names)
+    for name in factor_names:
+        wells = sorted(well for (factor, level), wells in index.items() if factor == name for well in wells)
+        assert wells == list(range(343))
+    for (name, level), wells in index.items():
+        assert wells == sorted(design['Well'][design[name] == level])
+
+
+def test_index_design_scales_linearly():
+    sizes = [343, 1536, 10000]
+    times = [best_time(random_design(n)) for n in sizes]
+    # Fixed costs make the small designs slower per row, a quadratic index
+    # would take 40 times longer per 6.5 times the rows
+    assert times[2] / times[1] < 3 * sizes[2] / sizes[1]
+    assert times[2] / times[0] < 3 * sizes[2] / sizes[0]